@@ -0,0 +1,176 @@
+import os
+import json
+import numpy as np
+
+KINDS = ("month", "doy")
+
+# an accumulator is [count, mean, M2] (Welford); variance = M2 / count
+
+
+def acc_merge(a, b):
+    # Chan et al. pairwise combination
+    n = a[0] + b[0]
+    if n == 0:
+        return [0, 0.0, 0.0]
+    delta = b[1] - a[1]
+    mean = a[1] + delta * b[0] / n
+    m2 = a[2] + b[2] + delta * delta * a[0] * b[0] / n
+    return [n, mean, m2]
+
+
+def acc_subtract(total, part):
+    # inverse of acc_merge: what is left of total once part is taken out
+    n = total[0] - part[0]
+    if n < 0:
+        raise ValueError("cannot subtract more values than the accumulator holds")
+    if n == 0:
+        return [0, 0.0, 0.0]
+    mean = (total[0] * total[1] - part[0] * part[1]) / n
+    delta = part[1] - mean
+    m2 = total[2] - part[2] - delta * delta * n * part[0] / total[0]
+    return [n, mean, max(m2, 0.0)]
+
+
+def acc_mean_std(acc):
+    if acc[0] == 0:
+        return None, None
+    return acc[1], (acc[2] / acc[0]) ** 0.5
+
+
+def group_keys(table, kind):
+    months = table.months()
+    if kind == "month":
+        return months
+    if kind == "doy":
+        # month*100 + day keeps Nov 5 on 1105 in leap and non-leap years
+        days = (table.dates - table.dates.astype("datetime64[M]")).astype(int) + 1
+        return months * 100 + days
+    raise ValueError(f"unknown baseline group: {kind}")
+
+
+def year_days(dates):
+    years = dates.astype("datetime64[Y]")
+    return years.astype(int) + 1970, (dates - years).astype(int)
+
+
+def group_accs(x, inverse, n_groups):
+    ok = ~np.isnan(x)
+    idx = inverse[ok]
+    xs = x[ok]
+    count = np.bincount(idx, minlength=n_groups)
+    total = np.bincount(idx, weights=xs, minlength=n_groups)
+    mean = np.divide(total, count, out=np.zeros(n_groups), where=count > 0)
+    m2 = np.bincount(idx, weights=(xs - mean[idx]) ** 2, minlength=n_groups)
+    return count, mean, m2
+
+
+class BaselineStore:
+    def __init__(self, path):
+        self.path = path
+        self.data = {}
+        self.added_days = 0
+        self.refreshed_days = 0
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.data = json.load(f)
+
+    def station(self, station_id):
+        return self.data.setdefault(station_id, {"last_date": None, "acc": {}, "seen": {}})
+
+    def ensure_seen(self, st, table):
+        # stores written before days were tracked folded in everything up to last_date
+        if "seen" not in st:
+            st["seen"] = {}
+            if st["last_date"] is not None:
+                self.mark_seen(st, table.slice_dates(None, st["last_date"]))
+
+    def mark_seen(self, st, table):
+        # one 366-character 0/1 string per year, indexed by day of year
+        years, days = year_days(table.dates)
+        for y in np.unique(years).tolist():
+            bits = np.frombuffer((st["seen"].get(str(y)) or "0" * 366).encode(), dtype=np.uint8).copy()
+            bits[days[years == y]] = ord("1")
+            st["seen"][str(y)] = bits.tobytes().decode()
+
+    def unseen(self, st, table):
+        years, days = year_days(table.dates)
+        mask = np.ones(len(table), dtype=bool)
+        for y in np.unique(years).tolist():
+            if str(y) in st["seen"]:
+                sel = years == y
+                bits = np.frombuffer(st["seen"][str(y)].encode(), dtype=np.uint8)
+                mask[sel] = bits[days[sel]] != ord("1")
+        return mask
+
+    def add_rows(self, st, table, variables, kinds):
+        years = table.years()
+        for kind in kinds:
+            combo = group_keys(table, kind) * 10000 + years
+            groups, inverse = np.unique(combo, return_inverse=True)
+            for var in variables:
+                count, mean, m2 = group_accs(table[var], inverse, len(groups))
+                for g, n, m, q in zip(groups.tolist(), count.tolist(), mean.tolist(), m2.tolist()):
+                    if n == 0:
+                        continue
+                    key, year = str(g // 10000), str(g % 10000)
+                    slot = st["acc"].setdefault(f"{var}|{kind}|{key}", {})
+                    slot[year] = acc_merge(slot.get(year, [0, 0.0, 0.0]), [n, m, q])
+
+    def add_table(self, station_id, table, variables, kinds=KINDS):
+        # only days the store has not folded in yet are added: reruns cost O(new days), and a
+        # backfilled older day is picked up as well as one past last_date
+        st = self.station(station_id)
+        self.ensure_seen(st, table)
+        table = table.take(self.unseen(st, table))
+        if len(table) == 0:
+            return 0
+        self.add_rows(st, table, variables, kinds)
+        self.mark_seen(st, table)
+        st["last_date"] = max(st["last_date"] or "", str(table.dates[-1]))
+        self.added_days += len(table)
+        return len(table)
+
+    def refresh_years(self, station_id, table, variables, years, kinds=KINDS):
+        # for upstream revisions of days already folded in: rebuild whole years from this table
+        st = self.station(station_id)
+        self.ensure_seen(st, table)
+        self.drop_years(station_id, years)
+        part = table.take(np.isin(table.years(), list(years)))
+        self.add_rows(st, part, variables, kinds)
+        self.mark_seen(st, part)
+        if len(part):
+            st["last_date"] = max(st["last_date"] or "", str(part.dates[-1]))
+        self.refreshed_days += len(part)
+        return len(part)
+
+    def drop_years(self, station_id, years):
+        st = self.station(station_id)
+        for slot in st["acc"].values():
+            for y in years:
+                slot.pop(str(y), None)
+        for y in years:
+            st.get("seen", {}).pop(str(y), None)
+
+    def accumulator(self, station_id, var, kind, key, start_year=None, end_year=None, exclude_years=()):
+        slot = self.station(station_id)["acc"].get(f"{var}|{kind}|{key}", {})
+        total = [0, 0.0, 0.0]
+        for y, acc in slot.items():
+            if start_year is not None and int(y) < start_year:
+                continue
+            if end_year is not None and int(y) > end_year:
+                continue
+            total = acc_merge(total, acc)
+        for y in exclude_years:
+            if str(y) in slot and (start_year is None or y >= start_year) and (end_year is None or y <= end_year):
+                total = acc_subtract(total, slot[str(y)])
+        return total
+
+    def baseline(self, station_id, var, kind, key, start_year=None, end_year=None, exclude_years=()):
+        acc = self.accumulator(station_id, var, kind, str(key), start_year, end_year, exclude_years)
+        return acc_mean_std(acc)
+
+    def save(self):
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.data, f)
+        os.replace(tmp, self.path)
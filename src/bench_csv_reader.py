@@ -0,0 +1,112 @@
+import os
+import time
+import random
+import argparse
+import tempfile
+from datetime import date, timedelta
+from csv_reader import read_columns
+
+
+# the per-character parser that clean_data/run_analysis/visualize_results used to copy
+def legacy_split_csv_line(line, want_cols):
+    out = []
+    cur = ""
+    in_q = False
+    i = 0
+    while i < len(line):
+        ch = line[i]
+        if ch == '"':
+            if in_q and i + 1 < len(line) and line[i + 1] == '"':
+                cur += '"'
+                i += 1
+            else:
+                in_q = not in_q
+        elif ch == "," and not in_q:
+            out.append(cur)
+            cur = ""
+        else:
+            cur += ch
+        i += 1
+    out.append(cur)
+    while len(out) < want_cols:
+        out.append("")
+    return out
+
+
+def legacy_to_float(x):
+    if x is None:
+        return None
+    s = str(x).strip()
+    if s == "":
+        return None
+    try:
+        return float(s)
+    except Exception:
+        return None
+
+
+def legacy_read_typed(path):
+    with open(path, "r", encoding="utf-8") as f:
+        lines = f.read().splitlines()
+    header = lines[0].split(",")
+    rows = []
+    for line in lines[1:]:
+        parts = legacy_split_csv_line(line, len(header))
+        r = {}
+        for i, k in enumerate(header):
+            v = parts[i] if i < len(parts) else ""
+            r[k] = v if k == "date" else legacy_to_float(v)
+        rows.append(r)
+    return rows
+
+
+def write_fake_daily(path, n_rows, seed=0):
+    rnd = random.Random(seed)
+    d0 = date(1900, 1, 1)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("date,AWND,PRCP,TMAX,TMIN,prcp_mm,temp_avg_c,prcp_z_nov\n")
+        for i in range(n_rows):
+            d = (d0 + timedelta(days=i % 60000)).isoformat()
+            awnd = "" if rnd.random() < 0.05 else f"{rnd.uniform(0, 9):.1f}"
+            prcp = f"{rnd.choice([0.0, 0.0, 0.0, rnd.uniform(0, 40)]):.1f}"
+            tmax = f"{rnd.uniform(12, 35):.1f}"
+            tmin = f"{rnd.uniform(3, 18):.1f}"
+            z = "" if rnd.random() < 0.5 else repr(rnd.gauss(0, 1))
+            f.write(f"{d},{awnd},{prcp},{tmax},{tmin},{float(prcp) / 10},{tmax},{z}\n")
+
+
+def time_it(fn, *args):
+    t0 = time.perf_counter()
+    out = fn(*args)
+    return time.perf_counter() - t0, out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=2_000_000)
+    parser.add_argument("--input", default=None)
+    args = parser.parse_args()
+
+    path = args.input
+    tmp = None
+    if path is None:
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, "fake_daily.csv")
+        write_fake_daily(path, args.rows)
+
+    size_mb = os.path.getsize(path) / 1e6
+    t_old, rows = time_it(legacy_read_typed, path)
+    t_new, cols = time_it(read_columns, path)
+
+    n = len(next(iter(cols.values()))) if cols else 0
+    print(f"file: {path} ({size_mb:.1f} MB, {n} rows)")
+    print(f"legacy split_csv_line + to_float: {t_old:.2f}s")
+    print(f"csv_reader.read_columns:          {t_new:.2f}s")
+    print(f"speedup: {t_old / t_new:.1f}x")
+
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
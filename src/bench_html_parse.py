@@ -0,0 +1,109 @@
+import os
+import glob
+import time
+import random
+import argparse
+import tempfile
+import scrape_timeanddate as td
+from ndjson_io import open_text
+
+DAY_NAMES = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+MONTH_NAMES = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+WEATHER = ["Sunny.", "Passing clouds.", "Partly sunny.", "Light rain. Overcast.", "Fog."]
+
+
+def fake_month_page(year, month, seed=0, obs_per_day=48, filler_tables=6):
+    # shaped like a timeanddate historic page: lots of chrome around one big wt-his table
+    rnd = random.Random(seed)
+    out = ["<!DOCTYPE html><html><head><title>Past Weather</title>"]
+    for i in range(20):
+        out.append(f'<script>window.cfg{i} = {{"a": {i}, "list": [{", ".join(str(j) for j in range(40))}]}};</script>')
+    out.append("<style>" + "".join(f".c{i}{{color:#{i:06x}}}" for i in range(300)) + "</style></head><body>")
+    out.append('<nav><ul>' + "".join(f'<li><a href="/p{i}">Link {i}</a></li>' for i in range(200)) + "</ul></nav>")
+    for t in range(filler_tables):
+        out.append(f'<table class="tb-{t}">')
+        for r in range(40):
+            out.append("<tr>" + "".join(f"<td>cell {t}.{r}.{c}</td>" for c in range(5)) + "</tr>")
+        out.append("</table>")
+
+    out.append('<table id="wt-his" class="zebra tb-wt fw va-m tb-hover"><thead><tr><th>Time</th><th>Temp</th>'
+               "<th>Weather</th><th>Wind</th><th>Humidity</th><th>Pressure</th><th>Visibility</th></tr></thead><tbody>")
+    for day in range(1, 31):
+        out.append(f"<tr><td>{DAY_NAMES[(day - 1) % 7]}, {MONTH_NAMES[month - 1]} {day}</td></tr>")
+        for k in range(obs_per_day):
+            hh, mm = divmod(k * 30, 60)
+            out.append(
+                f"<tr><td>{hh % 12 or 12}:{mm:02d}&nbsp;{'am' if hh < 12 else 'pm'}</td>"
+                f"<td>{rnd.randint(45, 85)}&nbsp;°F</td>"
+                f'<td class="small">{rnd.choice(WEATHER)}</td>'
+                f"<td>{rnd.randint(0, 20)} mph <span class=\"comp sa{rnd.randint(0, 15)}\">↑</span></td>"
+                f"<td>{rnd.randint(10, 100)}%</td>"
+                f"<td>{rnd.uniform(29.5, 30.5):.2f} \"Hg</td>"
+                f"<td>{rnd.choice([10, 9, 7, 2])}&nbsp;mi</td></tr>"
+            )
+    out.append("</tbody></table>")
+    out.append("<footer>" + "<p>footer text</p>" * 200 + "</footer></body></html>")
+    return "".join(out)
+
+
+def write_fake_pages(folder, n_pages):
+    paths = []
+    for i in range(n_pages):
+        year = 2015 + i
+        path = os.path.join(folder, f"timeanddate_fake_{year}_11.html")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(fake_month_page(year, 11, seed=i))
+        paths.append(path)
+    return paths
+
+
+def time_parser(fn, pages, repeat):
+    best = None
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = [fn(text, 2024, 11) for text in pages]
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best / len(pages), out
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--html", default="data/raw/timeanddate_html/*/*/*.html.gz")
+    parser.add_argument("--fake_pages", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    paths = sorted(glob.glob(args.html))
+    tmp = None
+    if not paths:
+        tmp = tempfile.TemporaryDirectory()
+        paths = write_fake_pages(tmp.name, args.fake_pages)
+
+    pages = []
+    for p in paths:
+        with open_text(p, "r") as f:
+            pages.append(f.read())
+    size_mb = sum(len(t) for t in pages) / 1e6
+
+    # a SoupStrainer-restricted html.parser run was tried too; it still tokenizes the whole page and was slower
+    parsers = [("full BeautifulSoup (old)", td.parse_hourly_rows_soup)]
+    if td.lxml_html is not None:
+        parsers.append(("lxml wt-his", td.parse_hourly_rows_lxml))
+
+    print(f"pages: {len(pages)} ({size_mb:.1f} MB){' synthetic' if tmp else ''}")
+    base_sec, base_rows = time_parser(parsers[0][1], pages, args.repeat)
+    for name, fn in parsers:
+        sec, rows = time_parser(fn, pages, args.repeat)
+        # a fast path that found no wt-his table falls back to the old parser, so compare what parse_hourly_rows returns
+        rows = [r if r is not None else td.parse_hourly_rows_soup(t, 2024, 11) for r, t in zip(rows, pages)]
+        same = "identical" if rows == base_rows else "MISMATCH"
+        print(f"{name:26s} {1000 * sec:8.1f} ms/month  {base_sec / sec:5.1f}x  {same}")
+
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
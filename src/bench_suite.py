@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+from daily_table import read_table_csv
+from ndjson_io import NdjsonWriter, iter_ndjson
+from clean_data import RAW_VARS, merge_daily_rows, add_features, add_rolling_many, add_month_baseline_z
+from run_analysis import SUMMARY_QS, quantiles
+from get_cdo_daily import to_daily_table, save_csv
+from scrape_timeanddate import parse_hourly_rows
+from bench_html_parse import fake_month_page
+import visualize_results
+
+END_YEAR = 2024
+CDO_TYPES = ["AWND", "PRCP", "TMAX", "TMIN"]
+
+
+def fake_station_days(n_years, seed):
+    # deterministic GHCND-shaped daily values: seasonal temperatures, mostly-dry rain, gaps everywhere
+    rng = np.random.default_rng(seed)
+    dates = np.arange(np.datetime64(f"{END_YEAR - n_years + 1}-01-01"), np.datetime64(f"{END_YEAR + 1}-01-01"))
+    n = len(dates)
+    doy = (dates - dates.astype("datetime64[Y]")).astype(int)
+    season = np.sin(2 * np.pi * (doy - 100) / 365.25)
+    tmax = np.round(22 + 6 * season + rng.normal(0, 3, n), 1)
+    tmin = np.round(tmax - 8 - np.abs(rng.normal(0, 2, n)), 1)
+    prcp = np.round(np.where(rng.random(n) < 0.85, 0.0, rng.gamma(0.8, 8, n)), 1)
+    awnd = np.round(rng.gamma(4, 0.8, n), 1)
+    cols = {"AWND": awnd, "PRCP": prcp, "TMAX": tmax, "TMIN": tmin}
+    for k in cols:
+        cols[k][rng.random(n) < 0.03] = np.nan
+    return dates, cols
+
+
+def write_station_csv(path, dates, cols):
+    text = [np.where(np.isnan(cols[k]), "", cols[k].astype(str)) for k in CDO_TYPES]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(",".join(CDO_TYPES) + ",date\n")
+        for parts in zip(*text, dates.astype(str)):
+            f.write(",".join(parts) + "\n")
+
+
+def write_station_ndjson(path, station, dates, cols):
+    day_text = [d + "T00:00:00" for d in dates.astype(str).tolist()]
+    with NdjsonWriter(path) as w:
+        for k in CDO_TYPES:
+            for d, v in zip(day_text, cols[k].tolist()):
+                if v == v:
+                    w.write({"date": d, "datatype": k, "station": station, "attributes": ",,W,", "value": v})
+
+
+def build_case(folder, station_idx, n_years, html_pages):
+    station = f"GHCND:FAKE{station_idx:05d}"
+    dates, cols = fake_station_days(n_years, seed=station_idx)
+    csv_path = os.path.join(folder, f"s{station_idx}.csv")
+    json_path = os.path.join(folder, f"s{station_idx}.ndjson.gz")
+    write_station_csv(csv_path, dates, cols)
+    write_station_ndjson(json_path, station, dates, cols)
+    first_year = END_YEAR - n_years + 1
+    pages = [fake_month_page(first_year + i % n_years, 11, seed=station_idx * 1000 + i, obs_per_day=24) for i in range(html_pages)]
+    return {"station": station, "csv": csv_path, "json": json_path, "pages": pages, "folder": folder, "first_year": first_year}
+
+
+def stage_cdo_json(ctx):
+    rows = to_daily_table(iter_ndjson(ctx["json"]))
+    save_csv(os.path.join(ctx["folder"], "from_json.csv"), rows)
+    return len(rows)
+
+
+def stage_read_csv(ctx):
+    ctx["table"] = read_table_csv(ctx["csv"], columns=RAW_VARS)
+    return len(ctx["table"])
+
+
+def stage_merge(ctx):
+    table = ctx["table"]
+    ctx["daily"] = merge_daily_rows([table, table.slice_dates(f"{END_YEAR}-11-01", None)])
+    return len(ctx["daily"])
+
+
+def stage_features(ctx):
+    add_features(ctx["daily"])
+    return len(ctx["daily"])
+
+
+def stage_rolling(ctx):
+    add_rolling_many(ctx["daily"], ["temp_avg_c", "prcp_mm"], [7, 14])
+    return len(ctx["daily"])
+
+
+def stage_baseline_z(ctx):
+    # baseline over every synthetic year, so the work grows with --years
+    add_month_baseline_z(ctx["daily"], "prcp_mm", 11, "prcp_z_nov", start_year=ctx["first_year"], end_year=END_YEAR)
+    return len(ctx["daily"])
+
+
+def stage_quantile(ctx):
+    vals = ctx["daily"].month_rows(11)["prcp_mm"].tolist()
+    quantiles(vals, SUMMARY_QS)
+    return len(vals)
+
+
+def stage_html(ctx):
+    n = 0
+    for text in ctx["pages"]:
+        n += len(parse_hourly_rows(text, END_YEAR, 11))
+    return n
+
+
+def stage_figures(ctx):
+    if not ctx["render"]:
+        return None
+    out = os.path.join(ctx["folder"], "figures")
+    os.makedirs(out, exist_ok=True)
+    visualize_results.render_all(ctx["daily"].select(visualize_results.INPUT_COLS), out)
+    return len(ctx["daily"])
+
+
+STAGES = [
+    ("cdo_ndjson_to_csv", stage_cdo_json),
+    ("read_csv", stage_read_csv),
+    ("merge_daily_rows", stage_merge),
+    ("add_features", stage_features),
+    ("add_rolling", stage_rolling),
+    ("add_month_baseline_z", stage_baseline_z),
+    ("quantile", stage_quantile),
+    ("parse_hourly_rows", stage_html),
+    ("figures", stage_figures),
+]
+
+
+def run_grid(stations_list, years_list, html_pages=None, figure_stations=1, memory=True, only=None):
+    results = {}
+    for n_years in years_list:
+        for n_stations in stations_list:
+            totals = {name: {"seconds": 0.0, "peak_mb": 0.0, "rows": 0, "units": 0} for name, _ in STAGES}
+            for i in range(n_stations):
+                with tempfile.TemporaryDirectory() as tmp:
+                    ctx = build_case(tmp, i, n_years, n_years if html_pages is None else html_pages)
+                    ctx["render"] = i < figure_stations
+                    for name, fn in STAGES:
+                        # the table-building stages always run since the rest read their output; only --stages are reported
+                        if only and name not in only and name not in ("read_csv", "merge_daily_rows", "add_features"):
+                            continue
+                        t0 = time.perf_counter()
+                        n = fn(ctx)
+                        dt = time.perf_counter() - t0
+                        if n is None:
+                            continue
+                        # a second, traced run gives the stage's own allocation peak without slowing the timed one
+                        peak = 0.0
+                        if memory:
+                            tracemalloc.start()
+                            fn(ctx)
+                            peak = tracemalloc.get_traced_memory()[1] / 1e6
+                            tracemalloc.stop()
+                        t = totals[name]
+                        t["seconds"] += dt
+                        t["peak_mb"] = max(t["peak_mb"], peak)
+                        t["rows"] += n
+                        t["units"] += 1
+            for name, t in totals.items():
+                if t["units"] and (not only or name in only):
+                    results[f"{name}|{n_stations}|{n_years}"] = {k: round(v, 4) if isinstance(v, float) else v for k, v in t.items()}
+    return results
+
+
+def machine_info():
+    return {
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold):
+    out = {}
+    for key, r in results.items():
+        base = baseline.get("results", {}).get(key)
+        # different --html_pages or generator output is a different workload
+        if not base or base["rows"] != r["rows"]:
+            continue
+        notes = []
+        # sub-10ms times and sub-1MB peaks are noise
+        if base["seconds"] >= 0.01:
+            ratio = r["seconds"] / base["seconds"]
+            notes.append((f"time {ratio:.2f}x", ratio > threshold))
+        if base["peak_mb"] >= 1.0 and r["peak_mb"] > 0:
+            ratio = r["peak_mb"] / base["peak_mb"]
+            notes.append((f"mem {ratio:.2f}x", ratio > threshold))
+        if notes:
+            out[key] = notes
+    return out
+
+
+def print_table(results, cmp):
+    print(f"{'stage':22s} {'stations':>8s} {'years':>5s} {'rows':>10s} {'seconds':>9s} {'peak_mb':>8s}  vs baseline")
+    for key, r in results.items():
+        name, n_stations, n_years = key.split("|")
+        note = "  ".join(text for text, _ in cmp.get(key, []))
+        if any(bad for _, bad in cmp.get(key, [])):
+            note += "  REGRESSION"
+        print(f"{name:22s} {n_stations:>8s} {n_years:>5s} {r['rows']:>10d} {r['seconds']:>9.3f} {r['peak_mb']:>8.1f}  {note}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", type=int, nargs="+", default=[1, 10])
+    parser.add_argument("--years", type=int, nargs="+", default=[10, 100])
+    parser.add_argument("--html_pages", type=int, default=None)
+    parser.add_argument("--figure_stations", type=int, default=1)
+    parser.add_argument("--stages", nargs="*", default=None)
+    parser.add_argument("--no_memory", action="store_true")
+    parser.add_argument("--baseline", default="data/bench_baseline.json")
+    parser.add_argument("--save_baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=1.3)
+    parser.add_argument("--strict", action="store_true")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    results = run_grid(args.stations, args.years, args.html_pages, args.figure_stations, not args.no_memory, args.stages)
+
+    baseline = None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    cmp = compare(results, baseline, args.threshold) if baseline else {}
+    print_table(results, cmp)
+    print(f"wall: {time.perf_counter() - t0:.1f}s")
+
+    if args.save_baseline:
+        # keep entries for sizes not run this time
+        merged = dict(baseline["results"]) if baseline else {}
+        merged.update(results)
+        folder = os.path.dirname(args.baseline)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"machine": machine_info(), "saved_at": time.strftime("%Y-%m-%d %H:%M:%S"), "results": merged}, f, indent=2)
+        print("baseline saved:", args.baseline)
+
+    n_bad = sum(1 for notes in cmp.values() if any(bad for _, bad in notes))
+    if n_bad:
+        print(f"{n_bad} stage(s) over {args.threshold}x baseline time or memory")
+        if args.strict:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
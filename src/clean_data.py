@@ -1,6 +1,13 @@
 import os
 import argparse
-from datetime import datetime
+import numpy as np
+from daily_table import DailyTable, COLS_SUFFIX, read_table_csv, save_table_csv, save_table_cols
+from baseline_store import BaselineStore
+from climatology import CLIM_VARS, add_climatology_z
+from metrics import add_metrics_args, count, instrumented, stage
+
+RAW_VARS = ["AWND", "PRCP", "TMAX", "TMIN"]
+BASELINE_VARS = ["prcp_mm", "tmax_c", "tmin_c", "temp_avg_c", "awnd_ms"]
 
 
 def make_folder(path):
@@ -8,147 +15,141 @@ def make_folder(path):
         os.makedirs(path)
 
 
-def split_csv_line(line, want_cols):
-    out = []
-    cur = ""
-    in_q = False
-    i = 0
-    while i < len(line):
-        ch = line[i]
-        if ch == '"':
-            if in_q and i + 1 < len(line) and line[i + 1] == '"':
-                cur += '"'
-                i += 1
-            else:
-                in_q = not in_q
-        elif ch == "," and not in_q:
-            out.append(cur)
-            cur = ""
-        else:
-            cur += ch
-        i += 1
-    out.append(cur)
-    while len(out) < want_cols:
-        out.append("")
-    return out
-
-
-def read_csv(path):
-    with open(path, "r", encoding="utf-8") as f:
-        lines = f.read().splitlines()
-    if not lines:
-        return []
-    header = lines[0].split(",")
-    rows = []
-    for line in lines[1:]:
-        parts = split_csv_line(line, len(header))
-        r = {}
-        for i, k in enumerate(header):
-            r[k] = parts[i] if i < len(parts) else ""
-        rows.append(r)
-    return rows
-
-
-def to_float(x):
-    if x is None:
-        return None
-    s = str(x).strip()
-    if s == "":
-        return None
-    try:
-        return float(s)
-    except Exception:
-        return None
-
-
-def parse_date(s):
-    try:
-        return datetime.strptime(s, "%Y-%m-%d").strftime("%Y-%m-%d")
-    except Exception:
-        return None
-
-
-def merge_daily_rows(rows_list):
-    daily = {}
-    for rows in rows_list:
-        for r in rows:
-            d = parse_date(r.get("date", ""))
-            if not d:
+def merge_daily_rows(tables):
+    tables = [t for t in tables if len(t)]
+    if not tables:
+        return DailyTable([])
+    dates = np.unique(np.concatenate([t.dates for t in tables]))
+    out = DailyTable(dates)
+    for k in RAW_VARS:
+        if not any(k in t for t in tables):
+            continue
+        col = np.full(len(dates), np.nan)
+        # later inputs win, and missing values never overwrite a real one
+        for t in tables:
+            if k not in t:
                 continue
-            if d not in daily:
-                daily[d] = {"date": d}
-
-            for k, v in r.items():
-                if k == "date":
-                    continue
-                if k in ["TMAX", "TMIN", "PRCP", "AWND"]:
-                    num = to_float(v)
-                    if num is not None:
-                        daily[d][k] = num
-
-    out = []
-    for d in sorted(daily.keys()):
-        out.append(daily[d])
+            vals = t[k]
+            ok = ~np.isnan(vals)
+            col[np.searchsorted(dates, t.dates[ok])] = vals[ok]
+        out.add_column(k, col)
     return out
 
 
-def add_features(rows):
-    for r in rows:
-        tmax = r.get("TMAX")
-        tmin = r.get("TMIN")
-        prcp = r.get("PRCP")
-        awnd = r.get("AWND")
-
-        if tmax is not None:
-            r["tmax_c"] = tmax / 10.0
-        else:
-            r["tmax_c"] = None
+def scaled(table, key):
+    if key in table:
+        return table[key] / 10.0
+    return np.full(len(table), np.nan)
+
+
+def add_features(table):
+    tmax = table["TMAX"] if "TMAX" in table else np.full(len(table), np.nan)
+    tmin = table["TMIN"] if "TMIN" in table else np.full(len(table), np.nan)
+    prcp = scaled(table, "PRCP")
+
+    table.add_column("tmax_c", tmax / 10.0)
+    table.add_column("tmin_c", tmin / 10.0)
+    table.add_column("temp_range_c", (tmax - tmin) / 10.0)
+    table.add_column("temp_avg_c", (tmax + tmin) / 20.0)
+    table.add_column("prcp_mm", np.where(np.isnan(prcp), 0.0, prcp))
+    table.add_column("awnd_ms", scaled(table, "AWND"))
+    table.add_column("year", table.years())
+    table.add_column("month", table.months())
+    return table
+
+
+def to_array(values):
+    if isinstance(values, np.ndarray):
+        return values.astype(float, copy=False)
+    return np.array([np.nan if x is None else x for x in values], dtype=float)
+
+
+def to_list(arr):
+    return [None if x != x else x for x in arr.tolist()]
+
+
+def window_starts(n, window):
+    return np.maximum(np.arange(n) - window + 1, 0)
+
+
+def window_extreme(x, window, fn):
+    # van Herk / Gil-Werman: block prefix + block suffix extremes, O(n) per window
+    n = len(x)
+    y = np.concatenate([np.full(window - 1, np.nan), x])
+    extra = (-len(y)) % window
+    y = np.concatenate([y, np.full(extra, np.nan)])
+    blocks = y.reshape(-1, window)
+    pre = fn.accumulate(blocks, axis=1).ravel()
+    suf = fn.accumulate(blocks[:, ::-1], axis=1)[:, ::-1].ravel()
+    ends = np.arange(window - 1, window - 1 + n)
+    return fn(suf[ends - window + 1], pre[ends])
+
+
+def rolling_stats(columns, windows, stats=("mean",)):
+    out = {}
+    for key, values in columns.items():
+        x = to_array(values)
+        n = len(x)
+        ok = ~np.isnan(x)
+        xs = np.where(ok, x, 0.0)
+
+        # NaN-aware prefix sums; the counts are integers so they stay exact
+        csum = np.concatenate([[0.0], np.cumsum(xs)])
+        ccount = np.concatenate([[0], np.cumsum(ok)])
+        cnonzero = np.concatenate([[0], np.cumsum(xs != 0)])
+
+        for w in windows:
+            left = window_starts(n, w)
+            count = ccount[1:] - ccount[left]
+            total = csum[1:] - csum[left]
+            # a window of only zeros sums to exactly 0.0, not prefix-sum noise
+            total[(cnonzero[1:] - cnonzero[left]) == 0] = 0.0
+
+            for st in stats:
+                if st == "count":
+                    res = count.astype(float)
+                elif st == "sum":
+                    res = np.where(count > 0, total, np.nan)
+                elif st == "mean":
+                    res = np.full(n, np.nan)
+                    np.divide(total, count, out=res, where=count > 0)
+                elif st == "min":
+                    res = window_extreme(x, w, np.fmin)
+                elif st == "max":
+                    res = window_extreme(x, w, np.fmax)
+                else:
+                    raise ValueError(f"unknown rolling stat: {st}")
+                out[(key, w, st)] = res
+    return out
 
-        if tmin is not None:
-            r["tmin_c"] = tmin / 10.0
-        else:
-            r["tmin_c"] = None
 
-        if tmax is not None and tmin is not None:
-            r["temp_range_c"] = (tmax - tmin) / 10.0
-            r["temp_avg_c"] = (tmax + tmin) / 20.0
-        else:
-            r["temp_range_c"] = None
-            r["temp_avg_c"] = None
+def rolling_name(key, window, stat):
+    if stat == "mean":
+        return f"{key}_roll{window}"
+    return f"{key}_roll{window}_{stat}"
 
-        if prcp is None:
-            r["prcp_mm"] = 0.0
-        else:
-            r["prcp_mm"] = prcp / 10.0
 
-        if awnd is not None:
-            r["awnd_ms"] = awnd / 10.0
-        else:
-            r["awnd_ms"] = None
-
-        r["year"] = int(r["date"][:4])
-        r["month"] = int(r["date"][5:7])
-
-    return rows
+def rolling_avg(values, window):
+    res = rolling_stats({"x": values}, [window], ["mean"])
+    return to_list(res[("x", window, "mean")])
 
 
-def rolling_avg(values, window):
-    out = []
-    for i in range(len(values)):
-        left = i - window + 1
-        if left < 0:
-            left = 0
-        chunk = [x for x in values[left : i + 1] if x is not None]
-        out.append((sum(chunk) / len(chunk)) if chunk else None)
-    return out
+def add_rolling(table, key, window, new_key):
+    res = rolling_stats({key: table[key]}, [window], ["mean"])
+    table.add_column(new_key, res[(key, window, "mean")])
+    return table
 
 
-def add_rolling(rows, key, window, new_key):
-    vals = [r.get(key) for r in rows]
-    roll = rolling_avg(vals, window)
-    for i in range(len(rows)):
-        rows[i][new_key] = roll[i]
-    return rows
+def add_rolling_many(table, keys, windows, stats=("mean",)):
+    res = rolling_stats({k: table[k] for k in keys}, windows, stats)
+    for w in windows:
+        for k in keys:
+            for st in stats:
+                vals = res[(k, w, st)]
+                if st == "count":
+                    vals = vals.astype(int)
+                table.add_column(rolling_name(k, w, st), vals)
+    return table
 
 
 def mean_std(vals):
@@ -160,78 +161,102 @@ def mean_std(vals):
     return m, v ** 0.5
 
 
-def add_month_baseline_z(rows, key, month, z_key):
-    base_vals = []
-    for r in rows:
-        if r.get("month") == month and r.get(key) is not None:
-            if 2015 <= r.get("year", 0) <= 2024:
-                base_vals.append(r.get(key))
-
-    m, s = mean_std(base_vals)
-
-    for r in rows:
-        x = r.get(key)
-        if x is None or m is None or s is None or s == 0:
-            r[z_key] = None
+def add_month_baseline_z(table, key, month, z_key, start_year=2015, end_year=2024, store=None, station=None):
+    x = table[key]
+    if store is not None:
+        m, s = store.baseline(station, key, "month", month, start_year, end_year)
+    else:
+        base = x[table.month_mask(month) & table.year_mask(start_year, end_year) & ~np.isnan(x)]
+        m, s = mean_std(base.tolist())
+
+    if m is None or s is None or s == 0:
+        table.add_column(z_key, np.full(len(table), np.nan))
+    else:
+        table.add_column(z_key, (x - m) / s)
+    return table
+
+
+def build_daily(raw_paths, store=None, station=None, clim=None, windows=(7, 14), refresh_years=()):
+    with stage("read_csv"):
+        tables = [read_table_csv(p, columns=RAW_VARS) for p in raw_paths]
+    count("clean.rows_in", sum(len(t) for t in tables))
+
+    with stage("merge_daily_rows"):
+        daily = merge_daily_rows(tables)
+    with stage("add_features"):
+        daily = add_features(daily)
+
+    with stage("add_rolling"):
+        daily = add_rolling_many(daily, ["temp_avg_c", "prcp_mm"], list(windows))
+
+    with stage("add_month_baseline_z"):
+        if store is not None:
+            if refresh_years:
+                store.refresh_years(station, daily, BASELINE_VARS, refresh_years)
+            store.add_table(station, daily, BASELINE_VARS)
+        daily = add_month_baseline_z(daily, "prcp_mm", 11, "prcp_z_nov", store=store, station=station)
+    for by in (clim or {}).get("by", []):
+        with stage("climatology_" + by):
+            daily = add_climatology_z(daily, CLIM_VARS, by, clim["start_year"], clim["end_year"], clim["smooth"] if by == "doy" else 0)
+    count("clean.days_out", len(daily))
+    return daily
+
+
+def daily_paths(processed_folder, fmt="csv", name="la_daily_cdo"):
+    paths = []
+    if fmt in ("csv", "both"):
+        paths.append(os.path.join(processed_folder, name + ".csv"))
+    if fmt in ("cols", "both"):
+        paths.append(os.path.join(processed_folder, name + COLS_SUFFIX))
+    return paths
+
+
+def save_daily(daily, processed_folder, fmt="csv", name="la_daily_cdo"):
+    paths = daily_paths(processed_folder, fmt, name)
+    for path in paths:
+        if path.endswith(COLS_SUFFIX):
+            save_table_cols(path, daily)
         else:
-            r[z_key] = (x - m) / s
-
-    return rows
-
-
-def save_csv(path, rows):
-    if not rows:
-        with open(path, "w", encoding="utf-8") as f:
-            f.write("")
-        return
-
-    keys = list(rows[0].keys())
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(",".join(keys) + "\n")
-        for r in rows:
-            parts = []
-            for k in keys:
-                v = r.get(k)
-                if v is None:
-                    parts.append("")
-                else:
-                    s = str(v).replace('"', '""')
-                    if "," in s or "\n" in s:
-                        s = f'"{s}"'
-                    parts.append(s)
-            f.write(",".join(parts) + "\n")
+            save_table_csv(path, daily)
+    return paths
 
 
 def main():
     parser = argparse.ArgumentParser()
     parser.add_argument("--raw_folder", default="data/raw")
     parser.add_argument("--processed_folder", default="data/processed")
+    parser.add_argument("--extra_daily", nargs="*", default=[])
+    parser.add_argument("--format", choices=["csv", "cols", "both"], default="csv")
+    parser.add_argument("--windows", type=int, nargs="+", default=[7, 14])
+    parser.add_argument("--baseline_store", default=None)
+    parser.add_argument("--station", default="GHCND:USW00023174")
+    parser.add_argument("--refresh_baseline_years", type=int, nargs="*", default=[])
+    parser.add_argument("--climatology", nargs="*", choices=["month", "doy"], default=[])
+    parser.add_argument("--clim_start", type=int, default=2015)
+    parser.add_argument("--clim_end", type=int, default=2024)
+    parser.add_argument("--clim_smooth", type=int, default=15)
+    add_metrics_args(parser, "clean_data")
     args = parser.parse_args()
 
-    make_folder(args.processed_folder)
-
-    p1 = os.path.join(args.raw_folder, "cdo_hist_nov_2015_2024_daily.csv")
-    p2 = os.path.join(args.raw_folder, "cdo_nov_dec_2024_daily.csv")
-
-    rows1 = read_csv(p1)
-    rows2 = read_csv(p2)
-
-    daily = merge_daily_rows([rows1, rows2])
-    daily = add_features(daily)
-
-    daily = add_rolling(daily, "temp_avg_c", 7, "temp_avg_c_roll7")
-    daily = add_rolling(daily, "prcp_mm", 7, "prcp_mm_roll7")
-    daily = add_rolling(daily, "temp_avg_c", 14, "temp_avg_c_roll14")
-    daily = add_rolling(daily, "prcp_mm", 14, "prcp_mm_roll14")
+    with instrumented(args):
+        make_folder(args.processed_folder)
 
-    daily = add_month_baseline_z(daily, "prcp_mm", 11, "prcp_z_nov")
+        p1 = os.path.join(args.raw_folder, "cdo_hist_nov_2015_2024_daily.csv")
+        p2 = os.path.join(args.raw_folder, "cdo_nov_dec_2024_daily.csv")
 
-    out_path = os.path.join(args.processed_folder, "la_daily_cdo.csv")
-    save_csv(out_path, daily)
+        store = BaselineStore(args.baseline_store) if args.baseline_store else None
+        clim = {"by": args.climatology, "start_year": args.clim_start, "end_year": args.clim_end, "smooth": args.clim_smooth}
+        daily = build_daily(
+            [p1, p2] + args.extra_daily, store, args.station, clim, args.windows, args.refresh_baseline_years
+        )
+        if store is not None:
+            store.save()
+            print(f"baseline store: {store.added_days} new days folded in, {store.refreshed_days} rebuilt")
 
-    print(out_path)
-    print("days:", len(daily))
+        for path in save_daily(daily, args.processed_folder, args.format):
+            print(path)
+        print("days:", len(daily))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,78 @@
+import numpy as np
+
+CLIM_VARS = ["prcp_mm", "tmax_c", "tmin_c", "awnd_ms"]
+N_GROUPS = {"month": 12, "doy": 366}
+
+
+def doy_index(dates):
+    # 0..365 on a leap-year calendar, so Mar 1 is slot 60 in every year and Feb 29 gets its own slot
+    years = dates.astype("datetime64[Y]")
+    doy = (dates - years.astype("datetime64[D]")).astype(int)
+    y = years.astype(int) + 1970
+    leap = (y % 4 == 0) & ((y % 100 != 0) | (y % 400 == 0))
+    return doy + ((~leap) & (doy >= 59))
+
+
+def group_index(table, by):
+    if by == "month":
+        return table.months() - 1
+    if by == "doy":
+        return doy_index(table.dates)
+    raise ValueError(f"unknown climatology grouping: {by}")
+
+
+def circular_sum(x, half):
+    # sum over a +-half window with wrap-around (Dec 31 neighbours Jan 1)
+    if half <= 0:
+        return x
+    padded = np.concatenate([x[-half:], x, x[:half]])
+    c = np.concatenate([[0.0], np.cumsum(padded)])
+    w = 2 * half + 1
+    return c[w:] - c[:-w]
+
+
+def group_stats(x, groups, n_groups, smooth=0):
+    ok = ~np.isnan(x)
+    idx = groups[ok]
+    xs = x[ok]
+    count = np.bincount(idx, minlength=n_groups).astype(float)
+    total = np.bincount(idx, weights=xs, minlength=n_groups)
+    mean = np.divide(total, count, out=np.zeros(n_groups), where=count > 0)
+    m2 = np.bincount(idx, weights=(xs - mean[idx]) ** 2, minlength=n_groups)
+
+    if smooth > 0:
+        # pool neighbouring groups: M2 = sum(M2_i) + sum(n_i * mean_i^2) - N * mean^2
+        count_w = circular_sum(count, smooth)
+        total_w = circular_sum(total, smooth)
+        mean_w = np.divide(total_w, count_w, out=np.zeros(n_groups), where=count_w > 0)
+        m2 = circular_sum(m2, smooth) + circular_sum(count * mean * mean, smooth) - count_w * mean_w * mean_w
+        count, mean, m2 = count_w, mean_w, np.maximum(m2, 0.0)
+
+    std = np.sqrt(np.divide(m2, count, out=np.full(n_groups, np.nan), where=count > 0))
+    mean = np.where(count > 0, mean, np.nan)
+    return count, mean, std
+
+
+def climatology(table, variables=CLIM_VARS, by="month", start_year=2015, end_year=2024, smooth=0):
+    groups = group_index(table, by)
+    base = table.year_mask(start_year, end_year)
+    n_groups = N_GROUPS[by]
+    out = {}
+    for var in variables:
+        out[var] = group_stats(table[var][base], groups[base], n_groups, smooth)
+    return out
+
+
+def add_climatology_z(table, variables=CLIM_VARS, by="month", start_year=2015, end_year=2024, smooth=0):
+    groups = group_index(table, by)
+    clim = climatology(table, variables, by, start_year, end_year, smooth)
+    for var in variables:
+        _, mean, std = clim[var]
+        m = mean[groups]
+        s = std[groups]
+        # same rule as add_month_baseline_z: no spread means no z-score
+        ok = s > 0
+        z = np.full(len(table), np.nan)
+        np.divide(table[var] - m, s, out=z, where=ok)
+        table.add_column(f"{var}_z_{by}", z)
+    return table
@@ -0,0 +1,120 @@
+import re
+import csv
+from itertools import repeat
+from datetime import datetime
+import numpy as np
+from metrics import count
+
+
+CHUNK_BYTES = 256 << 10
+DATE_RE = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
+
+def guess_kind(values, sample=2000):
+    # None while a column has been blank so far, so the caller can wait for a block with values
+    vals = [v for v in values if v.strip() != ""][:sample]
+    if not vals:
+        return None
+    if all(DATE_RE.match(v) for v in vals):
+        return "date"
+    try:
+        for v in vals:
+            float(v)
+        return "float"
+    except ValueError:
+        return "str"
+
+
+def floats_from_text(values):
+    try:
+        return np.array([v or "nan" for v in values], dtype=float)
+    except ValueError:
+        out = np.empty(len(values))
+        bad = 0
+        for i, v in enumerate(values):
+            try:
+                out[i] = float(v)
+            except ValueError:
+                out[i] = np.nan
+                # blank cells are ordinary missing values; only text that is not a number counts
+                bad += v.strip() != ""
+        count("csv.bad_floats", bad)
+        return out
+
+
+def dates_from_text(values):
+    if set(map(len, values)) <= {0, 10}:
+        try:
+            return np.array(values, dtype="datetime64[D]")
+        except ValueError:
+            pass
+    out = np.full(len(values), np.datetime64("NaT"), dtype="datetime64[D]")
+    bad = 0
+    for i, v in enumerate(values):
+        try:
+            out[i] = np.datetime64(datetime.strptime(v, "%Y-%m-%d").date(), "D")
+        except ValueError:
+            bad += v.strip() != ""
+    count("csv.bad_dates", bad)
+    return out
+
+
+def convert(values, kind):
+    if kind == "float":
+        return floats_from_text(values)
+    if kind == "date":
+        return dates_from_text(values)
+    return np.array(values, dtype=object)
+
+
+def split_block(lines, n_cols):
+    text = "".join(lines)
+    # the stride split is only safe when every line has exactly n_cols fields; a short row next to a long one
+    # would still add up to the right total and shift values across rows
+    if '"' not in text and set(map(str.count, lines, repeat(","))) == {n_cols - 1}:
+        if text.endswith("\n"):
+            text = text[:-1]
+        fields = text.replace("\n", ",").split(",")
+        if len(fields) == len(lines) * n_cols:
+            return [fields[j::n_cols] for j in range(n_cols)]
+    # quoted or ragged block: let the csv module sort it out row by row
+    rows = []
+    for parts in csv.reader(lines):
+        if len(parts) < n_cols:
+            parts += [""] * (n_cols - len(parts))
+        rows.append(parts[:n_cols])
+    return [[r[j] for r in rows] for j in range(n_cols)]
+
+
+def read_columns(path, schema=None, columns=None):
+    kinds = dict(schema) if schema else {}
+    with open(path, "r", encoding="utf-8") as f:
+        first = f.readline()
+        if not first:
+            return {}
+        header = next(csv.reader([first]))
+        n_cols = len(header)
+        want = [k for k in header if columns is None or k in columns]
+        idx = [header.index(k) for k in want]
+        parts = {k: [] for k in want}
+
+        while True:
+            lines = f.readlines(CHUNK_BYTES)
+            if not lines:
+                break
+            block = split_block(lines, n_cols)
+            for k, i in zip(want, idx):
+                if kinds.get(k) is None:
+                    kinds[k] = guess_kind(block[i])
+                if kinds[k] is None:
+                    # keep the blank text until a later block shows what the column holds
+                    parts[k].append(block[i])
+                else:
+                    parts[k].append(convert(block[i], kinds[k]))
+
+    out = {}
+    for k in want:
+        kind = kinds.get(k) or "float"
+        chunks = [convert(p, kind) if isinstance(p, list) else p for p in parts[k]]
+        out[k] = np.concatenate(chunks) if chunks else convert([], kind)
+    return out
@@ -0,0 +1,221 @@
+import os
+import json
+import shutil
+import numpy as np
+from csv_reader import read_columns
+from metrics import count
+
+COLS_SUFFIX = ".cols"
+
+
+def to_day(d):
+    return np.datetime64(d, "D")
+
+
+def month_ordinal(year, month):
+    return (year - 1970) * 12 + month - 1
+
+
+class DateIndex:
+    # month_offsets[i] is the first row on or after month first_month + i; the last entry is len(dates)
+    def __init__(self, dates):
+        if len(dates) == 0:
+            self.first_month = 0
+            self.month_offsets = np.zeros(1, dtype=np.int64)
+            return
+        months = dates.astype("datetime64[M]")
+        bounds = np.arange(months[0], months[-1] + 2)
+        self.first_month = int(months[0].astype(int))
+        self.month_offsets = np.searchsorted(dates, bounds.astype("datetime64[D]"), side="left")
+
+    def offset(self, ordinal):
+        i = min(max(ordinal - self.first_month, 0), len(self.month_offsets) - 1)
+        return int(self.month_offsets[i])
+
+    def month_slice(self, year, month):
+        m = month_ordinal(year, month)
+        return slice(self.offset(m), self.offset(m + 1))
+
+    def year_slice(self, start_year, end_year=None):
+        end_year = start_year if end_year is None else end_year
+        return slice(self.offset(month_ordinal(start_year, 1)), self.offset(month_ordinal(end_year + 1, 1)))
+
+    def span_years(self):
+        last = self.first_month + len(self.month_offsets) - 2
+        return 1970 + self.first_month // 12, 1970 + max(last, self.first_month) // 12
+
+    def calendar_rows(self, month, start_year=None, end_year=None):
+        lo, hi = self.span_years()
+        start_year = lo if start_year is None else max(start_year, lo)
+        end_year = hi if end_year is None else min(end_year, hi)
+        parts = [np.arange(sl.start, sl.stop) for sl in (self.month_slice(y, month) for y in range(start_year, end_year + 1))]
+        return np.concatenate(parts) if parts else np.zeros(0, dtype=np.int64)
+
+
+class DailyTable:
+    def __init__(self, dates, cols=None):
+        self.dates = np.asarray(dates, dtype="datetime64[D]")
+        self.date_index = None
+        self.cols = {}
+        for k, v in (cols or {}).items():
+            self.add_column(k, v)
+
+    def __len__(self):
+        return len(self.dates)
+
+    def __contains__(self, key):
+        return key in self.cols
+
+    def __getitem__(self, key):
+        if key == "date":
+            return self.dates
+        return self.cols[key]
+
+    def names(self):
+        return ["date"] + list(self.cols.keys())
+
+    def add_column(self, key, values):
+        arr = np.asarray(values)
+        if arr.dtype.kind not in "iu":
+            arr = arr.astype(float, copy=False)
+        if arr.shape != self.dates.shape:
+            raise ValueError(f"column {key} has {arr.shape[0]} values, table has {len(self)} days")
+        self.cols[key] = arr
+        return self
+
+    def years(self):
+        return self.dates.astype("datetime64[Y]").astype(int) + 1970
+
+    def months(self):
+        return self.dates.astype("datetime64[M]").astype(int) % 12 + 1
+
+    def year_mask(self, start_year, end_year=None):
+        y = self.years()
+        if end_year is None:
+            end_year = start_year
+        return (y >= start_year) & (y <= end_year)
+
+    def month_mask(self, month):
+        return self.months() == month
+
+    def date_slice(self, start=None, end=None):
+        left = 0 if start is None else np.searchsorted(self.dates, to_day(start), side="left")
+        right = len(self) if end is None else np.searchsorted(self.dates, to_day(end), side="right")
+        return slice(int(left), int(right))
+
+    def index(self):
+        # dates never change after construction, so the index is built once per table
+        if self.date_index is None:
+            self.date_index = DateIndex(self.dates)
+        return self.date_index
+
+    def view(self, sl):
+        # basic slicing, so every column of the result is a view
+        return DailyTable(self.dates[sl], {k: v[sl] for k, v in self.cols.items()})
+
+    def slice_dates(self, start=None, end=None):
+        return self.view(self.date_slice(start, end))
+
+    def year_rows(self, start_year, end_year=None):
+        return self.view(self.index().year_slice(start_year, end_year))
+
+    def month_rows(self, month, start_year=None, end_year=None):
+        if start_year is not None and start_year == end_year:
+            return self.view(self.index().month_slice(start_year, month))
+        return self.take(self.index().calendar_rows(month, start_year, end_year))
+
+    def take(self, mask):
+        return DailyTable(self.dates[mask], {k: v[mask] for k, v in self.cols.items()})
+
+    def select(self, keys):
+        return DailyTable(self.dates, {k: self.cols[k] for k in keys if k != "date"})
+
+    def values(self, key):
+        arr = self[key]
+        if key == "date":
+            return arr.astype(str).tolist()
+        return [None if x != x else x for x in arr.tolist()]
+
+    def to_rows(self):
+        keys = self.names()
+        cols = [self.values(k) for k in keys]
+        return [dict(zip(keys, one)) for one in zip(*cols)]
+
+    def nbytes(self):
+        return self.dates.nbytes + sum(v.nbytes for v in self.cols.values())
+
+
+def format_column(arr):
+    if arr.dtype.kind == "M":
+        return arr.astype(str).tolist()
+    if arr.dtype.kind in "iu":
+        return [str(x) for x in arr.tolist()]
+    return ["" if x != x else str(x) for x in arr.tolist()]
+
+
+def save_table_csv(path, table, keys=None):
+    keys = keys or table.names()
+    cols = [format_column(table[k]) for k in keys]
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(",".join(keys) + "\n")
+        for parts in zip(*cols):
+            f.write(",".join(parts) + "\n")
+
+
+def read_table_csv(path, columns=None):
+    if columns is not None and "date" not in columns:
+        columns = ["date"] + list(columns)
+    cols = read_columns(path, schema={"date": "date"}, columns=columns)
+    if "date" not in cols:
+        return DailyTable([])
+    dates = cols.pop("date")
+    ok = ~np.isnat(dates)
+    count("csv.rows_read", len(dates))
+    count("csv.rows_dropped", len(dates) - int(ok.sum()))
+    order = np.argsort(dates[ok], kind="stable")
+    return DailyTable(dates[ok][order], {k: v[ok][order] for k, v in cols.items() if v.dtype.kind != "O"})
+
+
+def save_table_cols(folder, table):
+    # one .npy per column next to a small meta.json; readers mmap only what they ask for
+    tmp = folder.rstrip("/") + ".tmp"
+    if os.path.exists(tmp):
+        shutil.rmtree(tmp)
+    os.makedirs(tmp)
+    meta = {"version": 1, "days": len(table), "columns": {}}
+    for k in table.names():
+        arr = np.ascontiguousarray(table[k])
+        np.save(os.path.join(tmp, k + ".npy"), arr)
+        meta["columns"][k] = str(arr.dtype)
+    if len(table):
+        meta["first_date"] = str(table.dates[0])
+        meta["last_date"] = str(table.dates[-1])
+    with open(os.path.join(tmp, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump(meta, f, indent=2)
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.replace(tmp, folder)
+
+
+def read_table_cols(folder, columns=None, start=None, end=None):
+    with open(os.path.join(folder, "meta.json"), "r", encoding="utf-8") as f:
+        meta = json.load(f)
+    dates = np.load(os.path.join(folder, "date.npy"), mmap_mode="r")
+    full = DailyTable(dates)
+    sl = full.date_slice(start, end)
+
+    keys = [k for k in meta["columns"] if k != "date" and (columns is None or k in columns)]
+    cols = {}
+    for k in keys:
+        arr = np.load(os.path.join(folder, k + ".npy"), mmap_mode="r")
+        cols[k] = np.array(arr[sl])
+    return DailyTable(np.array(dates[sl]), cols)
+
+
+def read_table(path, columns=None, start=None, end=None):
+    if os.path.isdir(path):
+        return read_table_cols(path, columns, start, end)
+    table = read_table_csv(path, columns)
+    if start is not None or end is not None:
+        table = table.slice_dates(start, end)
+    return table
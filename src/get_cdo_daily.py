@@ -1,8 +1,22 @@
 import os
 import json
 import time
+import random
 import argparse
+import threading
+from datetime import date, datetime, timedelta, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import requests
+from http_client import shared_client, format_report, retry_after_seconds
+from response_cache import active_cache, use_cache, ttl_for_range
+from ndjson_io import NdjsonWriter, iter_ndjson
+from metrics import add_metrics_args, count, instrumented, stage
+
+CDO_PER_SEC = 5
+CDO_PER_DAY = 10000
+PAGE_LIMIT = 1000
+SEQUENTIAL_PER_SEC = 4
+DATATYPES = ["TMAX", "TMIN", "PRCP", "AWND"]
 
 
 def make_folder(p):
@@ -38,7 +52,148 @@ def save_csv(path, rows):
             f.write(",".join(line) + "\n")
 
 
-def fetch_one_page(token, station_id, start_date, end_date, offset, limit):
+class TokenBucket:
+    def __init__(self, rate=CDO_PER_SEC, capacity=None, per_day=CDO_PER_DAY):
+        self.rate = rate
+        self.capacity = capacity or 1
+        self.tokens = self.capacity
+        self.per_day = per_day
+        self.used_today = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.used_today >= self.per_day:
+                    raise RuntimeError(f"CDO daily quota of {self.per_day} requests used up")
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    self.used_today += 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AdaptiveGate:
+    # AIMD concurrency for the CDO API: the in-flight limit grows by one after a full round of clean
+    # responses and halves on 429, whose Retry-After pauses every caller. Growing back past the level
+    # that was throttled takes probe_rounds rounds, so the limit settles just under it. 5xx and timeouts
+    # back off per caller, and a run of them opens a breaker that fails fast until a trial request gets through
+    def __init__(
+        self, max_limit=1, start=1, fail_threshold=5, cooldown=60.0, base_backoff=1.0, max_backoff=120.0, probe_rounds=8
+    ):
+        self.cond = threading.Condition()
+        self.max_limit = max(1, max_limit)
+        self.limit = min(max(1, start), self.max_limit)
+        self.fail_threshold = fail_threshold
+        self.cooldown = cooldown
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.probe_rounds = probe_rounds
+        self.local = threading.local()
+        self.epoch = 0
+        self.ceiling = None
+        self.in_flight = 0
+        self.streak = 0
+        self.failures = 0
+        self.paused_until = 0.0
+        self.open_until = None
+        self.stats = {"peak_limit": self.limit, "throttled": 0, "failed": 0, "breaker_opened": 0}
+
+    def __enter__(self):
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                if self.open_until is not None and now < self.open_until:
+                    raise RuntimeError(
+                        f"CDO circuit open after {self.failures} failures in a row; retry in {self.open_until - now:.1f}s"
+                    )
+                # once the cooldown is over a single trial request decides whether to close again
+                limit = 1 if self.open_until is not None else self.limit
+                if now >= self.paused_until and self.in_flight < limit:
+                    self.in_flight += 1
+                    self.local.epoch = self.epoch
+                    return self
+                self.cond.wait(self.paused_until - now if now < self.paused_until else None)
+
+    def __exit__(self, exc_type, exc, tb):
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+    def backoff(self, attempt):
+        # jitter keeps callers that failed together from retrying together
+        return min(self.max_backoff, self.base_backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+
+    def succeeded(self):
+        with self.cond:
+            self.failures = 0
+            self.open_until = None
+            self.streak += 1
+            rounds = self.probe_rounds if self.ceiling is not None and self.limit + 1 >= self.ceiling else 1
+            if self.streak >= rounds * self.limit and self.limit < self.max_limit:
+                self.limit += 1
+                self.streak = 0
+                self.stats["peak_limit"] = max(self.stats["peak_limit"], self.limit)
+            self.cond.notify_all()
+
+    def throttled(self, retry_after, attempt):
+        with self.cond:
+            # requests that were already in flight when the limit was cut belong to the same push-back
+            if getattr(self.local, "epoch", self.epoch) == self.epoch:
+                self.ceiling = self.limit
+                self.limit = max(1, self.limit // 2)
+                self.epoch += 1
+            self.streak = 0
+            self.stats["throttled"] += 1
+            delay = (retry_after if retry_after is not None else self.backoff(attempt)) + random.uniform(0, 1.0)
+            self.paused_until = max(self.paused_until, time.monotonic() + delay)
+            return delay
+
+    def failed(self, attempt):
+        with self.cond:
+            self.failures += 1
+            self.streak = 0
+            self.stats["failed"] += 1
+            now = time.monotonic()
+            if self.failures >= self.fail_threshold and (self.open_until is None or now >= self.open_until):
+                self.open_until = now + self.cooldown
+                self.stats["breaker_opened"] += 1
+            self.cond.notify_all()
+            return self.backoff(attempt)
+
+    def report(self):
+        with self.cond:
+            s = self.stats
+            return (
+                f"cdo gate: limit={self.limit}/{self.max_limit} peak={s['peak_limit']} "
+                f"throttled={s['throttled']} failed={s['failed']} breaker_opened={s['breaker_opened']}"
+            )
+
+
+_gate = None
+_gate_lock = threading.Lock()
+
+
+def shared_gate(**kw):
+    global _gate
+    with _gate_lock:
+        if _gate is None:
+            _gate = AdaptiveGate(**kw)
+        return _gate
+
+
+def fetch_one_page(
+    token, station_id, start_date, end_date, offset, limit, limiter=None, client=None, cache=None, cached=True,
+    gate=None, tries=5
+):
+    client = client or shared_client()
+    gate = gate or shared_gate()
+    cache = (cache or active_cache()) if cached else None
     url = "https://www.ncei.noaa.gov/cdo-web/api/v2/data"
     headers = {"token": token}
     params = {
@@ -49,42 +204,70 @@ def fetch_one_page(token, station_id, start_date, end_date, offset, limit):
         "units": "metric",
         "limit": limit,
         "offset": offset,
-        "datatypeid": ["TMAX", "TMIN", "PRCP", "AWND"],
+        "datatypeid": DATATYPES,
     }
 
-    last_err = None
-    for try_num in range(1, 6):
-        try:
-            r = requests.get(url, headers=headers, params=params, timeout=120)
-            if r.status_code != 200:
-                raise RuntimeError(f"CDO error {r.status_code}: {r.text[:220]}")
-            return r.json()
-        except Exception as e:
-            last_err = e
-            time.sleep(2 * try_num)
-
-    raise last_err
-
-
-def pull_range(token, station_id, start_date, end_date):
-    all_rows = []
+    def fetch():
+        for attempt in range(tries):
+            r, err = None, None
+            with gate:
+                if limiter is not None:
+                    limiter.acquire()
+                try:
+                    r = client.get(url, headers=headers, params=params)
+                    if r.status_code == 200:
+                        data = r.json()
+                        gate.succeeded()
+                        return data
+                except (requests.RequestException, ValueError) as e:
+                    err = e
+
+            if err is None:
+                err = RuntimeError(f"CDO error {r.status_code}: {r.text[:220]}")
+                # other 4xx (bad token, bad params) will not get better by asking again
+                if r.status_code < 500 and r.status_code != 429:
+                    raise err
+            if r is not None and r.status_code == 429:
+                # quota push-back: the gate pauses everyone for Retry-After and halves concurrency,
+                # but it is not a failure as far as the breaker is concerned
+                gate.throttled(retry_after_seconds(r.headers.get("Retry-After")), attempt)
+                delay = 0
+            else:
+                delay = gate.failed(attempt)
+            if attempt + 1 == tries:
+                raise err
+            count("http.retries")
+            time.sleep(delay)
+
+    data = fetch() if cache is None else cache.fetch_json(url, params, fetch, ttl_for_range(end_date))
+    count("cdo.pages")
+    count("cdo.records", len(data.get("results", [])))
+    return data
+
+
+def iter_range_pages(token, station_id, start_date, end_date, limiter=None, cached=True):
+    # the 0.25 s gap between pages is a 4 req/s bucket, so cached pages skip it
+    limiter = limiter or TokenBucket(rate=SEQUENTIAL_PER_SEC)
     offset = 1
-    limit = 1000
+    limit = PAGE_LIMIT
 
     while True:
-        data = fetch_one_page(token, station_id, start_date, end_date, offset, limit)
-        results = data.get("results", [])
-        all_rows += results
+        data = fetch_one_page(token, station_id, start_date, end_date, offset, limit, limiter, cached=cached)
+        yield data.get("results", [])
 
         meta = data.get("metadata", {}).get("resultset", {})
-        count = meta.get("count", 0)
+        total = meta.get("count", 0)
 
-        if offset + limit > count:
+        if offset + limit > total:
             break
 
         offset += limit
-        time.sleep(0.25)
 
+
+def pull_range(token, station_id, start_date, end_date, limiter=None, cached=True):
+    all_rows = []
+    for page in iter_range_pages(token, station_id, start_date, end_date, limiter, cached):
+        all_rows += page
     return all_rows
 
 
@@ -111,45 +294,305 @@ def to_daily_table(rows):
     return out
 
 
-def pull_many_small_ranges(token, station_id, start_year, end_year, month):
+def iter_pages(token, station_id, ranges, workers=1, limiter=None):
+    if workers > 1:
+        yield from iter_ranges_pages(token, station_id, ranges, workers, limiter)
+        return
+
+    limiter = limiter or TokenBucket(rate=SEQUENTIAL_PER_SEC)
+    for start_date, end_date in ranges:
+        yield from iter_range_pages(token, station_id, start_date, end_date, limiter)
+
+
+def pull_many_small_ranges(token, station_id, start_year, end_year, month, workers=1, limiter=None):
     all_rows = []
-    for y in range(start_year, end_year + 1):
-        start_date = f"{y}-{month:02d}-01"
-        end_date = f"{y}-{month:02d}-30"
-        part = pull_range(token, station_id, start_date, end_date)
-        all_rows += part
-        time.sleep(0.25)
+    for page in iter_pages(token, station_id, month_ranges(start_year, end_year, month), workers, limiter):
+        all_rows += page
     return all_rows
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--out", default="data/raw")
-    parser.add_argument("--station", default="GHCND:USW00023174")
-    args = parser.parse_args()
+def page_offsets(total, limit=PAGE_LIMIT):
+    return list(range(1 + limit, total + 1, limit))
+
+
+def iter_ranges_pages(token, station_id, ranges, workers=4, limiter=None):
+    # first page of every range tells us how many more pages to ask for.
+    # pages finish in any order but are yielded in (range, offset) order,
+    # so only the ones that arrive early are held in memory
+    limiter = limiter or TokenBucket()
+    done = {}
+    offsets = {}
+    next_i, next_j = 0, 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = {}
+        for i, (start_date, end_date) in enumerate(ranges):
+            fut = pool.submit(fetch_one_page, token, station_id, start_date, end_date, 1, PAGE_LIMIT, limiter)
+            pending[fut] = (i, 1)
+
+        while pending:
+            finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in finished:
+                i, offset = pending.pop(fut)
+                data = fut.result()
+                done[(i, offset)] = data.get("results", [])
+
+                if offset == 1:
+                    total = data.get("metadata", {}).get("resultset", {}).get("count", 0)
+                    offsets[i] = [1] + page_offsets(total)
+                    start_date, end_date = ranges[i]
+                    for off in offsets[i][1:]:
+                        more = pool.submit(
+                            fetch_one_page, token, station_id, start_date, end_date, off, PAGE_LIMIT, limiter
+                        )
+                        pending[more] = (i, off)
+
+            while next_i in offsets and (next_i, offsets[next_i][next_j]) in done:
+                yield done.pop((next_i, offsets[next_i][next_j]))
+                next_j += 1
+                if next_j == len(offsets[next_i]):
+                    next_i, next_j = next_i + 1, 0
+
+
+def pull_ranges(token, station_id, ranges, workers=4, limiter=None):
+    all_rows = []
+    for page in iter_ranges_pages(token, station_id, ranges, workers, limiter):
+        all_rows += page
+    return all_rows
+
 
-    token = os.environ.get("NOAA_TOKEN")
-    if not token:
-        raise RuntimeError('Missing NOAA_TOKEN. Set it like: export NOAA_TOKEN="..."')
+def month_ranges(start_year, end_year, month):
+    return [(f"{y}-{month:02d}-01", f"{y}-{month:02d}-30") for y in range(start_year, end_year + 1)]
 
-    make_folder(args.out)
 
-    rows_hist = pull_many_small_ranges(token, args.station, 2015, 2024, 11)
-    save_json(os.path.join(args.out, "cdo_hist_nov_2015_2024.json"), rows_hist)
-    daily_hist = to_daily_table(rows_hist)
-    save_csv(os.path.join(args.out, "cdo_hist_nov_2015_2024_daily.csv"), daily_hist)
-    print("hist records:", len(rows_hist), "days:", len(daily_hist))
+def dump_pages(pages, raw_path, csv_path):
+    # one page in memory at a time; the daily table is rebuilt by streaming the dump back
+    with stage("fetch_pages"):
+        with NdjsonWriter(raw_path) as w:
+            for page in pages:
+                w.write_many(page)
+    with stage("to_daily_table"):
+        daily = to_daily_table(iter_ndjson(raw_path))
+        save_csv(csv_path, daily)
+    count("cdo.days", len(daily))
+    return w.count, len(daily)
 
-    rows_2024_nov = pull_range(token, args.station, "2024-11-01", "2024-11-30")
-    rows_2024_dec = pull_range(token, args.station, "2024-12-01", "2024-12-31")
-    rows_recent = rows_2024_nov + rows_2024_dec
 
-    save_json(os.path.join(args.out, "cdo_nov_dec_2024.json"), rows_recent)
-    daily_recent = to_daily_table(rows_recent)
-    save_csv(os.path.join(args.out, "cdo_nov_dec_2024_daily.csv"), daily_recent)
-    print("recent records:", len(rows_recent), "days:", len(daily_recent))
+def fetch_default_ranges(token, station_id, out_folder, workers=1, limiter=None):
+    # November 2015-2024 baseline plus Nov-Dec 2024, the two raw files clean_data reads
+    hist_pages = iter_pages(token, station_id, month_ranges(2015, 2024, 11), workers, limiter)
+    n_hist, days_hist = dump_pages(
+        hist_pages,
+        os.path.join(out_folder, "cdo_hist_nov_2015_2024.ndjson.gz"),
+        os.path.join(out_folder, "cdo_hist_nov_2015_2024_daily.csv"),
+    )
+
+    recent_ranges = [("2024-11-01", "2024-11-30"), ("2024-12-01", "2024-12-31")]
+    recent_pages = iter_pages(token, station_id, recent_ranges, workers, limiter)
+    n_recent, days_recent = dump_pages(
+        recent_pages,
+        os.path.join(out_folder, "cdo_nov_dec_2024.ndjson.gz"),
+        os.path.join(out_folder, "cdo_nov_dec_2024_daily.csv"),
+    )
+    return [("hist", n_hist, days_hist), ("recent", n_recent, days_recent)]
+
+
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def month_chunks(start_date, end_date):
+    out = []
+    d = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
+    while d <= end:
+        nxt = date(d.year + d.month // 12, d.month % 12 + 1, 1)
+        out.append((d.isoformat(), min(nxt - timedelta(days=1), end).isoformat()))
+        d = nxt
+    return out
+
+
+def fetch_count(token, station_id, start_date, end_date, limiter):
+    # limit=1 costs one call and the resultset count is all we need; never cached
+    data = fetch_one_page(token, station_id, start_date, end_date, 1, 1, limiter, cached=False)
+    return data.get("metadata", {}).get("resultset", {}).get("count", 0)
+
+
+def station_slug(station_id):
+    return station_id.replace(":", "_")
+
+
+def truncate_to(path, size):
+    with open(path, "a+b") as f:
+        f.truncate(size)
+
+
+def dates_between(start_date, end_date):
+    d = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
+    while d <= end:
+        yield d.isoformat()
+        d += timedelta(days=1)
+
+
+def replay_store(path):
+    # the store is an append-only log: a {"replace": [a, b]} record drops whatever was held for those
+    # dates and the rows after it are the fresh copy. Returns the daily table and the records per day
+    daily = {}
+    counts = {}
+    if not os.path.exists(path):
+        return daily, counts
+    for r in iter_ndjson(path):
+        if "replace" in r:
+            for d in dates_between(*r["replace"]):
+                daily.pop(d, None)
+                counts.pop(d, None)
+            continue
+        d = r.get("date", "")[:10]
+        t = r.get("datatype")
+        if not d or not t:
+            continue
+        daily.setdefault(d, {"date": d})[t] = r.get("value")
+        counts[d] = counts.get(d, 0) + 1
+    return daily, counts
+
+
+def held_count(day_counts, start_date, end_date):
+    return sum(n for d, n in day_counts.items() if start_date <= d <= end_date)
+
+
+def incremental_update(
+    token, station_id, out_folder, first_date, through, limiter, recheck_months=1, recheck_all=False, recheck_days=14
+):
+    slug = station_slug(station_id)
+    store_path = os.path.join(out_folder, f"cdo_{slug}_store.ndjson.gz")
+    marks_path = os.path.join(out_folder, "cdo_watermarks.json")
+
+    marks = load_json(marks_path, {})
+    mark = marks.setdefault(station_id, {"datatypes": {}})
+    mark.pop("months", None)
+    held_bytes = os.path.getsize(store_path) if os.path.exists(store_path) else 0
+    if "store_bytes" in mark and held_bytes < mark["store_bytes"]:
+        print(f"{store_path} is shorter than its watermark says, fetching from {first_date} again")
+        mark = marks[station_id] = {"datatypes": {}}
+        truncate_to(store_path, 0)
+    elif "store_bytes" in mark:
+        # a run that died while appending leaves a half-written tail past the last saved size
+        truncate_to(store_path, mark["store_bytes"])
+    if "days" not in mark:
+        mark["days"] = replay_store(store_path)[1]
+
+    fetched = [mark["datatypes"].get(t) for t in DATATYPES]
+    last = min(fetched) if all(fetched) else None
+    start = first_date
+    if last is not None:
+        # CDO publishes days late, so the trailing recheck_days before the watermark are always fetched again
+        start = max(first_date, (date.fromisoformat(last) + timedelta(days=1 - recheck_days)).isoformat())
+
+    # months before that window that upstream may have revised since
+    stale = []
+    if last is not None and start > first_date:
+        held = month_chunks(first_date, (date.fromisoformat(start) - timedelta(days=1)).isoformat())
+        check = held if recheck_all else held[-recheck_months:] if recheck_months > 0 else []
+        for a, b in check:
+            upstream = fetch_count(token, station_id, a, b, limiter)
+            if upstream != held_count(mark["days"], a, b):
+                stale.append((a, b))
+
+    todo = stale + (month_chunks(start, through) if start <= through else [])
+    for a, b in todo:
+        part = pull_range(token, station_id, a, b, limiter, cached=False)
+        # one gzip member per range, checkpointed in the watermarks so a crash costs at most this range
+        with NdjsonWriter(store_path, append=True) as w:
+            w.write({"replace": [a, b]})
+            w.write_many(part)
+        for d in dates_between(a, b):
+            mark["days"].pop(d, None)
+        for r in part:
+            d = r.get("date", "")[:10]
+            mark["days"][d] = mark["days"].get(d, 0) + 1
+        mark["store_bytes"] = os.path.getsize(store_path)
+        save_json(marks_path, marks)
+
+    if start <= through:
+        for t in DATATYPES:
+            mark["datatypes"][t] = through
+    mark["store_bytes"] = os.path.getsize(store_path) if os.path.exists(store_path) else 0
+
+    daily = replay_store(store_path)[0]
+    save_csv(os.path.join(out_folder, f"cdo_{slug}_store_daily.csv"), [daily[d] for d in sorted(daily)])
+    save_json(marks_path, marks)
+    return store_path, len(todo), len(stale), sum(mark["days"].values())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--out", default="data/raw")
+    parser.add_argument("--station", default="GHCND:USW00023174")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--cache_dir", default="data/cache")
+    parser.add_argument("--cache_max_mb", type=float, default=500)
+    parser.add_argument("--no_cache", action="store_true")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--incremental", action="store_true")
+    parser.add_argument("--first_date", default="2015-01-01")
+    parser.add_argument("--through", default=None)
+    parser.add_argument("--recheck_months", type=int, default=1)
+    parser.add_argument("--recheck_all", action="store_true")
+    parser.add_argument("--recheck_days", type=int, default=14)
+    parser.add_argument("--breaker_failures", type=int, default=5)
+    parser.add_argument("--breaker_cooldown", type=float, default=60)
+    add_metrics_args(parser, "get_cdo_daily")
+    args = parser.parse_args()
 
-    print("saved in:", args.out)
+    with instrumented(args):
+        if args.offline and args.incremental:
+            parser.error("--incremental needs the network; it cannot run with --offline")
+
+        token = os.environ.get("NOAA_TOKEN", "")
+        if not token and not args.offline:
+            raise RuntimeError('Missing NOAA_TOKEN. Set it like: export NOAA_TOKEN="..."')
+
+        make_folder(args.out)
+        cache = None
+        if not args.no_cache or args.offline:
+            cache = use_cache(args.cache_dir, max_bytes=int(args.cache_max_mb * 1024 * 1024), offline=args.offline)
+        client = shared_client(timeout=(10, args.timeout), per_host=max(args.workers, 1))
+        # starts at one request in flight and ramps up to --workers while the API keeps answering
+        gate = shared_gate(max_limit=args.workers, fail_threshold=args.breaker_failures, cooldown=args.breaker_cooldown)
+
+        limiter = TokenBucket() if args.workers > 1 else TokenBucket(rate=SEQUENTIAL_PER_SEC)
+
+        if args.incremental:
+            through = args.through or datetime.now(timezone.utc).date().isoformat()
+            store_path, n_ranges, n_stale, n_rows = incremental_update(
+                token,
+                args.station,
+                args.out,
+                args.first_date,
+                through,
+                limiter,
+                args.recheck_months,
+                args.recheck_all,
+                args.recheck_days,
+            )
+            print(store_path)
+            print("ranges fetched:", n_ranges, "re-fetched after upstream change:", n_stale, "records:", n_rows)
+            print(format_report(client.report()))
+            print(gate.report())
+            return
+
+        for name, n_records, n_days in fetch_default_ranges(token, args.station, args.out, args.workers, limiter):
+            print(f"{name} records:", n_records, "days:", n_days)
+
+        print("saved in:", args.out)
+        print(format_report(client.report()))
+        print(gate.report())
+        if cache is not None:
+            print(cache.report())
 
 
 if __name__ == "__main__":
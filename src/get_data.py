@@ -3,7 +3,10 @@ import json
 import time
 import argparse
 from datetime import datetime
-import requests
+from http_client import shared_client, format_report
+from response_cache import active_cache, use_cache, ttl_for_range
+from ndjson_io import NdjsonWriter
+from metrics import add_metrics_args, count, instrumented
 
 
 def make_folder(path):
@@ -45,9 +48,18 @@ def flatten_one_obs(item):
     return out
 
 
-def save_json(path, obj):
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(obj, f, ensure_ascii=False, indent=2)
+def csv_line(r, keys):
+    parts = []
+    for k in keys:
+        val = r.get(k)
+        if val is None:
+            parts.append("")
+        else:
+            s = str(val).replace('"', '""')
+            if "," in s or "\n" in s:
+                s = f'"{s}"'
+            parts.append(s)
+    return ",".join(parts) + "\n"
 
 
 def save_csv(path, rows):
@@ -60,59 +72,141 @@ def save_csv(path, rows):
     with open(path, "w", encoding="utf-8") as f:
         f.write(",".join(keys) + "\n")
         for r in rows:
-            parts = []
-            for k in keys:
-                val = r.get(k)
-                if val is None:
-                    parts.append("")
-                else:
-                    s = str(val).replace('"', '""')
-                    if "," in s or "\n" in s:
-                        s = f'"{s}"'
-                    parts.append(s)
-            f.write(",".join(parts) + "\n")
-
-
-def fetch_noaa_observations(station_id, start_iso, end_iso, user_agent):
+            f.write(csv_line(r, keys))
+
+
+def iter_noaa_cursor_pages(station_id, start_iso, end_iso, user_agent, client=None, cache=None, resume_url=None):
+    # yields (features, next cursor); the cursor is all that is needed to pick up after that page
+    client = client or shared_client()
+    cache = cache or active_cache()
     url = f"https://api.weather.gov/stations/{station_id}/observations"
     headers = {"User-Agent": user_agent, "Accept": "application/geo+json"}
 
-    all_items = []
-    next_url = url
-    params = {"start": start_iso, "end": end_iso, "limit": 100}
+    if resume_url:
+        next_url = resume_url
+        params = None
+    else:
+        next_url = url
+        params = {"start": start_iso, "end": end_iso, "limit": 100}
 
-    while True:
-        resp = requests.get(next_url, headers=headers, params=params, timeout=30)
+    def fetch():
+        resp = client.get(next_url, headers=headers, params=params)
         if resp.status_code != 200:
             raise RuntimeError(f"weather.gov returned {resp.status_code}: {resp.text[:200]}")
+        time.sleep(0.3)
+        return resp.json()
 
-        data = resp.json()
-        items = data.get("features", [])
-        all_items.extend(items)
+    while True:
+        if cache is None:
+            data = fetch()
+        else:
+            data = cache.fetch_json(next_url, params, fetch, ttl_for_range(end_iso))
 
         links = (data.get("properties") or {}).get("next")
+        yield data.get("features", []), links or None
         if not links:
             break
 
         next_url = links
         params = None
-        time.sleep(0.3)
 
+
+def iter_noaa_pages(station_id, start_iso, end_iso, user_agent, client=None, cache=None):
+    for items, _ in iter_noaa_cursor_pages(station_id, start_iso, end_iso, user_agent, client, cache):
+        yield items
+
+
+def fetch_noaa_observations(station_id, start_iso, end_iso, user_agent, client=None, cache=None):
+    all_items = []
+    for items in iter_noaa_pages(station_id, start_iso, end_iso, user_agent, client, cache):
+        all_items.extend(items)
     return all_items
 
 
-def run_one_range(station_id, start_iso, end_iso, out_folder, user_agent):
-    raw_name = f"noaa_{station_id}_{start_iso[:10]}_{end_iso[:10]}"
-    raw_json_path = os.path.join(out_folder, raw_name + ".json")
-    raw_csv_path = os.path.join(out_folder, raw_name + ".csv")
+def load_json(path, default):
+    if not os.path.exists(path):
+        return default
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_json(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
 
-    items = fetch_noaa_observations(station_id, start_iso, end_iso, user_agent)
-    save_json(raw_json_path, items)
+def truncate_to(path, size):
+    with open(path, "a+b") as f:
+        f.truncate(size)
 
-    flat = [flatten_one_obs(x) for x in items]
-    save_csv(raw_csv_path, flat)
 
-    return raw_json_path, raw_csv_path, len(items)
+def holds_checkpoint(path, size):
+    # a missing or short partial cannot be cut back to the checkpoint; truncate would pad it with zeros
+    return os.path.exists(path) and os.path.getsize(path) >= size
+
+
+def run_one_range(station_id, start_iso, end_iso, out_folder, user_agent, restart=False):
+    raw_name = f"noaa_{station_id}_{start_iso[:10]}_{end_iso[:10]}"
+    raw_json_path = os.path.join(out_folder, raw_name + ".ndjson.gz")
+    raw_csv_path = os.path.join(out_folder, raw_name + ".csv")
+    part_json_path = os.path.join(out_folder, raw_name + ".partial.ndjson.gz")
+    part_csv_path = os.path.join(out_folder, raw_name + ".partial.csv")
+    cursor_path = os.path.join(out_folder, raw_name + ".cursor.json")
+
+    range_id = [station_id, start_iso, end_iso]
+    state = None if restart else load_json(cursor_path, None)
+    if state is not None and state.get("range") == range_id and not (
+        holds_checkpoint(part_json_path, state["json_bytes"]) and holds_checkpoint(part_csv_path, state["csv_bytes"])
+    ):
+        print(f"checkpoint for {raw_name} does not match the partial files, starting over")
+        state = None
+    if state is not None and state.get("range") == range_id:
+        # anything written after the last checkpoint is a half-finished page: cut it off
+        truncate_to(part_json_path, state["json_bytes"])
+        truncate_to(part_csv_path, state["csv_bytes"])
+        print(f"resuming {raw_name} after page {state['pages']} ({state['records']} records)")
+    else:
+        state = {"range": range_id, "next": None, "pages": 0, "records": 0, "json_bytes": 0, "csv_bytes": 0, "keys": None}
+        for p in [part_json_path, part_csv_path]:
+            truncate_to(p, 0)
+
+    if state["pages"] == 0:
+        pages = iter_noaa_cursor_pages(station_id, start_iso, end_iso, user_agent)
+    elif state["next"]:
+        pages = iter_noaa_cursor_pages(station_id, start_iso, end_iso, user_agent, resume_url=state["next"])
+    else:
+        pages = []
+
+    # one page in memory at a time; each page is its own gzip member so the files can be cut back to any checkpoint
+    for items, next_url in pages:
+        with NdjsonWriter(part_json_path, append=True) as w:
+            w.write_many(items)
+        with open(part_csv_path, "a", encoding="utf-8") as f:
+            for x in items:
+                row = flatten_one_obs(x)
+                if state["keys"] is None:
+                    state["keys"] = list(row.keys())
+                    f.write(",".join(state["keys"]) + "\n")
+                f.write(csv_line(row, state["keys"]))
+
+        count("weathergov.pages")
+        count("weathergov.records", len(items))
+        state["next"] = next_url
+        state["pages"] += 1
+        state["records"] += len(items)
+        state["json_bytes"] = os.path.getsize(part_json_path)
+        state["csv_bytes"] = os.path.getsize(part_csv_path)
+        save_json(cursor_path, state)
+
+    # the cursor goes first: a run that dies during the renames starts over instead of resuming from it
+    if os.path.exists(cursor_path):
+        os.remove(cursor_path)
+    for part, final in [(part_json_path, raw_json_path), (part_csv_path, raw_csv_path)]:
+        if os.path.exists(part):
+            os.replace(part, final)
+    return raw_json_path, raw_csv_path, state["records"]
 
 
 def main():
@@ -124,20 +218,35 @@ def main():
     parser.add_argument("--end", default="2024-11-30T23:59:59+00:00")
     parser.add_argument("--extra_start", default="2024-11-01T00:00:00+00:00")
     parser.add_argument("--extra_end", default="2024-12-31T23:59:59+00:00")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--cache_dir", default="data/cache")
+    parser.add_argument("--cache_max_mb", type=float, default=500)
+    parser.add_argument("--no_cache", action="store_true")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--restart", action="store_true")
+    add_metrics_args(parser, "get_data")
     args = parser.parse_args()
 
-    make_folder(args.out)
-
-    a_json, a_csv, a_n = run_one_range(args.station, args.start, args.end, args.out, args.user_agent)
-    b_json, b_csv, b_n = run_one_range(args.station, args.extra_start, args.extra_end, args.out, args.user_agent)
-
-    print("Saved:")
-    print(a_json)
-    print(a_csv)
-    print(f"records: {a_n}")
-    print(b_json)
-    print(b_csv)
-    print(f"records: {b_n}")
+    with instrumented(args):
+        make_folder(args.out)
+        client = shared_client(timeout=(10, args.timeout))
+        cache = None
+        if not args.no_cache or args.offline:
+            cache = use_cache(args.cache_dir, max_bytes=int(args.cache_max_mb * 1024 * 1024), offline=args.offline)
+
+        a_json, a_csv, a_n = run_one_range(args.station, args.start, args.end, args.out, args.user_agent, args.restart)
+        b_json, b_csv, b_n = run_one_range(args.station, args.extra_start, args.extra_end, args.out, args.user_agent, args.restart)
+
+        print("Saved:")
+        print(a_json)
+        print(a_csv)
+        print(f"records: {a_n}")
+        print(b_json)
+        print(b_csv)
+        print(f"records: {b_n}")
+        print(format_report(client.report()))
+        if cache is not None:
+            print(cache.report())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,136 @@
+import time
+import threading
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from metrics import count
+
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_PER_HOST = 8
+
+
+class HostStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+    def one(self, host):
+        if host not in self.hosts:
+            self.hosts[host] = {"requests": 0, "handshakes": 0, "total_sec": 0.0, "max_sec": 0.0, "bytes": 0}
+        return self.hosts[host]
+
+    def add_handshake(self, host):
+        with self.lock:
+            self.one(host)["handshakes"] += 1
+
+    def add_request(self, host, seconds, n_bytes):
+        with self.lock:
+            h = self.one(host)
+            h["requests"] += 1
+            h["total_sec"] += seconds
+            h["max_sec"] = max(h["max_sec"], seconds)
+            h["bytes"] += n_bytes
+
+    def snapshot(self):
+        with self.lock:
+            out = {}
+            for host, h in self.hosts.items():
+                one = dict(h)
+                one["mean_ms"] = 1000 * h["total_sec"] / h["requests"] if h["requests"] else None
+                one["max_ms"] = 1000 * h["max_sec"]
+                out[host] = one
+            return out
+
+
+def counting_pool(base, stats):
+    # every _new_conn is a fresh TCP (+TLS) handshake; reused keep-alive sockets never get here
+    class CountingPool(base):
+        def _new_conn(self):
+            stats.add_handshake(self.host)
+            return super()._new_conn()
+
+    return CountingPool
+
+
+class PooledAdapter(HTTPAdapter):
+    def __init__(self, stats, **kw):
+        self.stats = stats
+        super().__init__(**kw)
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        super().init_poolmanager(connections, maxsize, block=block, **pool_kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": counting_pool(HTTPConnectionPool, self.stats),
+            "https": counting_pool(HTTPSConnectionPool, self.stats),
+        }
+
+
+class HttpClient:
+    def __init__(self, timeout=DEFAULT_TIMEOUT, per_host=DEFAULT_PER_HOST, headers=None):
+        self.timeout = timeout
+        self.stats = HostStats()
+        self.session = requests.Session()
+        self.session.headers.update({"Accept-Encoding": "gzip, deflate", "Connection": "keep-alive"})
+        if headers:
+            self.session.headers.update(headers)
+
+        # pool_block makes extra threads wait for a free socket instead of opening more
+        adapter = PooledAdapter(self.stats, pool_connections=16, pool_maxsize=per_host, pool_block=True)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def get(self, url, **kw):
+        kw.setdefault("timeout", self.timeout)
+        host = urlsplit(url).hostname or ""
+        t0 = time.perf_counter()
+        r = self.session.get(url, **kw)
+        self.stats.add_request(host, time.perf_counter() - t0, len(r.content))
+        count("http.requests")
+        count("http.bytes", len(r.content))
+        if r.status_code != 200:
+            count(f"http.status_{r.status_code}")
+        return r
+
+    def report(self):
+        return self.stats.snapshot()
+
+    def close(self):
+        self.session.close()
+
+
+def retry_after_seconds(value):
+    # Retry-After is either delta-seconds or an HTTP date
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def format_report(report):
+    lines = []
+    for host, h in sorted(report.items()):
+        mean = f"{h['mean_ms']:.0f}" if h["mean_ms"] is not None else "-"
+        lines.append(
+            f"{host}: requests={h['requests']} handshakes={h['handshakes']} "
+            f"mean_ms={mean} max_ms={h['max_ms']:.0f} bytes={h['bytes']}"
+        )
+    return "\n".join(lines)
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_client(**kw):
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = HttpClient(**kw)
+        return _shared
@@ -0,0 +1,126 @@
+import os
+import sys
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb(who="self"):
+    # ru_maxrss is KiB on Linux and bytes on macOS; not available on Windows
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_SELF if who == "self" else resource.RUSAGE_CHILDREN)
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(usage.ru_maxrss / scale, 1)
+
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+
+    @contextmanager
+    def stage(self, name):
+        # nested stages are recorded as "outer/inner"; each thread keeps its own nesting
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        stack.append(name)
+        full = "/".join(stack)
+        t0 = time.perf_counter()
+        c0 = time.thread_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - t0
+            cpu = time.thread_time() - c0
+            stack.pop()
+            with self.lock:
+                s = self.stages.setdefault(full, {"calls": 0, "wall_sec": 0.0, "cpu_sec": 0.0})
+                s["calls"] += 1
+                s["wall_sec"] += wall
+                s["cpu_sec"] += cpu
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        with self.lock:
+            stages = {k: {"calls": v["calls"], "wall_sec": round(v["wall_sec"], 4), "cpu_sec": round(v["cpu_sec"], 4)}
+                      for k, v in self.stages.items()}
+            return {
+                "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+                "wall_sec": round(time.time() - self.started, 3),
+                "cpu_sec": round(time.process_time(), 3),
+                "peak_rss_mb": peak_rss_mb(),
+                "children_peak_rss_mb": peak_rss_mb("children"),
+                "stages": stages,
+                "counters": dict(sorted(self.counters.items())),
+            }
+
+    def save(self, path, extra=None):
+        out = self.snapshot()
+        out.update(extra or {})
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(out, f, indent=2)
+        return out
+
+
+_current = Metrics()
+
+
+def current():
+    return _current
+
+
+def stage(name):
+    return _current.stage(name)
+
+
+def count(name, n=1):
+    _current.count(name, n)
+
+
+def add_metrics_args(parser, name):
+    parser.add_argument("--metrics", default=f"data/metrics/{name}.json")
+    parser.add_argument("--profile", action="store_true")
+
+
+@contextmanager
+def instrumented(args, top=40):
+    # wraps a main(): metrics JSON always, cProfile dump plus a text summary of the hot functions with --profile
+    prof = cProfile.Profile() if args.profile else None
+    if prof is not None:
+        prof.enable()
+    try:
+        yield _current
+    finally:
+        if prof is not None:
+            prof.disable()
+        if args.metrics:
+            _current.save(args.metrics, {"argv": sys.argv})
+            print("metrics:", args.metrics)
+        if prof is not None:
+            base = os.path.splitext(args.metrics or "data/metrics/run.json")[0]
+            folder = os.path.dirname(base)
+            if folder and not os.path.exists(folder):
+                os.makedirs(folder)
+            prof.dump_stats(base + ".prof")
+            with open(base + ".prof.txt", "w", encoding="utf-8") as f:
+                pstats.Stats(prof, stream=f).sort_stats("cumulative").print_stats(top)
+            print("profile:", base + ".prof")
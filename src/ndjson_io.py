@@ -0,0 +1,62 @@
+import os
+import gzip
+import json
+
+
+def open_text(path, mode, gz=None):
+    if gz is None:
+        gz = path.endswith(".gz")
+    if gz:
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class NdjsonWriter:
+    def __init__(self, path, append=False):
+        self.path = path
+        self.count = 0
+        # write next to the target and rename on close, so a crash never leaves half a file
+        self.tmp = None if append else path + ".part"
+        self.f = open_text(self.tmp or path, "a" if append else "w", gz=path.endswith(".gz"))
+
+    def write(self, record):
+        self.f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        self.f.write("\n")
+        self.count += 1
+
+    def write_many(self, records):
+        for r in records:
+            self.write(r)
+
+    def close(self):
+        self.f.close()
+        if self.tmp is not None:
+            os.replace(self.tmp, self.path)
+            self.tmp = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+
+
+def iter_ndjson(path):
+    with open_text(path, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def read_ndjson(path):
+    return list(iter_ndjson(path))
+
+
+def save_ndjson(path, records):
+    with NdjsonWriter(path) as w:
+        w.write_many(records)
+    return w.count
@@ -0,0 +1,94 @@
+import random
+import numpy as np
+
+DEFAULT_K = 200
+CHUNK = 1 << 16
+
+
+class KllSketch:
+    # KLL compactor stack: level h holds items of weight 2**h, memory stays O(k)
+    def __init__(self, k=DEFAULT_K, seed=None):
+        self.k = k
+        self.n = 0
+        self.levels = [np.empty(0)]
+        self.rng = random.Random(seed)
+
+    def capacity(self, h):
+        depth = len(self.levels) - 1 - h
+        return max(2, int(self.k * (2.0 / 3.0) ** depth))
+
+    def compress(self):
+        h = 0
+        while h < len(self.levels):
+            level = self.levels[h]
+            if len(level) >= self.capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                level = np.sort(level)
+                # an odd item out stays behind so total weight is preserved exactly
+                keep = level[-1:] if len(level) % 2 else level[:0]
+                pairs = level[: len(level) - len(keep)]
+                promoted = pairs[self.rng.randint(0, 1)::2]
+                self.levels[h + 1] = np.concatenate([self.levels[h + 1], promoted])
+                self.levels[h] = keep
+            h += 1
+
+    def update(self, values):
+        xs = np.asarray(values, dtype=float).ravel()
+        xs = xs[~np.isnan(xs)]
+        for i in range(0, len(xs), CHUNK):
+            part = xs[i : i + CHUNK]
+            self.levels[0] = np.concatenate([self.levels[0], part])
+            self.n += len(part)
+            self.compress()
+        return self
+
+    def merge(self, other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for h, level in enumerate(other.levels):
+            self.levels[h] = np.concatenate([self.levels[h], level])
+        self.n += other.n
+        self.compress()
+        return self
+
+    def quantiles(self, qs):
+        if self.n == 0:
+            return [None for _ in qs]
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(level), 2.0**h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind="stable")
+        items = items[order]
+        cum = np.cumsum(weights[order])
+        out = []
+        for q in qs:
+            i = int(np.searchsorted(cum, min(max(q, 0.0), 1.0) * cum[-1], side="left"))
+            out.append(float(items[min(i, len(items) - 1)]))
+        return out
+
+    def quantile(self, q):
+        return self.quantiles([q])[0]
+
+    def size(self):
+        return sum(len(level) for level in self.levels)
+
+    def to_dict(self):
+        return {"k": self.k, "n": self.n, "levels": [level.tolist() for level in self.levels]}
+
+
+def sketch_from_dict(d, seed=None):
+    sk = KllSketch(d["k"], seed)
+    sk.n = d["n"]
+    sk.levels = [np.array(level, dtype=float) for level in d["levels"]] or [np.empty(0)]
+    return sk
+
+
+def sketch_of(values, k=DEFAULT_K):
+    return KllSketch(k).update(values)
+
+
+def merge_sketches(sketches, k=DEFAULT_K):
+    out = KllSketch(k)
+    for sk in sketches:
+        out.merge(sk)
+    return out
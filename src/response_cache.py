@@ -0,0 +1,156 @@
+import os
+import json
+import gzip
+import time
+import hashlib
+import threading
+from datetime import datetime, timezone
+
+SHORT_TTL_SEC = 3600
+DEFAULT_MAX_BYTES = 500 * 1024 * 1024
+# eviction trims to this share of max_bytes, so a full cache walks the folder now and then instead of on every put
+LOW_WATER = 0.9
+
+
+class CacheMiss(RuntimeError):
+    pass
+
+
+def normalize_params(params):
+    out = []
+    for k, v in sorted((params or {}).items()):
+        if v is None:
+            continue
+        if isinstance(v, (list, tuple)):
+            v = ",".join(sorted(str(x) for x in v))
+        out.append((str(k), str(v)))
+    return out
+
+
+def cache_key(url, params=None):
+    text = json.dumps([url, normalize_params(params)], separators=(",", ":"))
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def ttl_for_range(end_date, now=None):
+    # closed months never change upstream; anything touching the current month can
+    now = now or datetime.now(timezone.utc)
+    month_start = now.strftime("%Y-%m-01")
+    if end_date and end_date[:10] < month_start:
+        return None
+    return SHORT_TTL_SEC
+
+
+class ResponseCache:
+    def __init__(self, folder, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(folder, exist_ok=True)
+        self.total_bytes = sum(os.path.getsize(p) for p in self.entry_paths())
+
+    def path_for(self, key):
+        return os.path.join(self.folder, key[:2], key + ".json.gz")
+
+    def entry_paths(self):
+        for root, _, files in os.walk(self.folder):
+            for name in files:
+                if name.endswith(".json.gz"):
+                    yield os.path.join(root, name)
+
+    def get(self, key):
+        path = self.path_for(key)
+        try:
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (OSError, EOFError, ValueError):
+            with self.lock:
+                self.misses += 1
+            if self.offline:
+                raise CacheMiss(f"--offline and no cached response for {key}")
+            return None
+
+        expires = entry.get("expires_at")
+        if not self.offline and expires is not None and expires < time.time():
+            with self.lock:
+                self.misses += 1
+            return None
+
+        # mtime doubles as the LRU clock
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self.lock:
+            self.hits += 1
+        return entry["body"]
+
+    def put(self, key, body, ttl_sec=SHORT_TTL_SEC, meta=None):
+        now = time.time()
+        entry = {
+            "fetched_at": now,
+            "expires_at": None if ttl_sec is None else now + ttl_sec,
+            "meta": meta or {},
+            "body": body,
+        }
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp, "wt", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+
+        with self.lock:
+            old = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp, path)
+            self.total_bytes += os.path.getsize(path) - old
+            if self.total_bytes > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        # other processes may share the folder, so files can vanish under us
+        entries = []
+        for p in self.entry_paths():
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, p))
+        entries.sort()
+        self.total_bytes = sum(size for _, size, _ in entries)
+        target = self.max_bytes * LOW_WATER
+        for _, size, p in entries:
+            if self.total_bytes <= target:
+                break
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+            self.total_bytes -= size
+
+    def fetch_json(self, url, params, fetch, ttl_sec=SHORT_TTL_SEC):
+        key = cache_key(url, params)
+        body = self.get(key)
+        if body is not None:
+            return body
+        body = fetch()
+        self.put(key, body, ttl_sec, meta={"url": url, "params": normalize_params(params)})
+        return body
+
+    def report(self):
+        return f"cache: hits={self.hits} misses={self.misses} size_mb={self.total_bytes / 1e6:.1f}"
+
+
+_active = None
+
+
+def use_cache(folder, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+    global _active
+    _active = ResponseCache(folder, max_bytes=max_bytes, offline=offline)
+    return _active
+
+
+def active_cache():
+    return _active
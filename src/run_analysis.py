@@ -1,6 +1,12 @@
 import os
 import argparse
-from datetime import datetime
+import numpy as np
+from daily_table import read_table, save_table_csv
+from baseline_store import BaselineStore
+from metrics import add_metrics_args, instrumented, stage
+
+OUT_KEYS = ["date", "prcp_mm", "prcp_z_nov", "temp_avg_c"]
+SUMMARY_QS = [0.50, 0.75, 0.90, 0.95]
 
 
 def make_folder(path):
@@ -8,59 +14,6 @@ def make_folder(path):
         os.makedirs(path)
 
 
-def split_csv_line(line, want_cols):
-    out = []
-    cur = ""
-    in_q = False
-    i = 0
-    while i < len(line):
-        ch = line[i]
-        if ch == '"':
-            if in_q and i + 1 < len(line) and line[i + 1] == '"':
-                cur += '"'
-                i += 1
-            else:
-                in_q = not in_q
-        elif ch == "," and not in_q:
-            out.append(cur)
-            cur = ""
-        else:
-            cur += ch
-        i += 1
-    out.append(cur)
-    while len(out) < want_cols:
-        out.append("")
-    return out
-
-
-def read_csv(path):
-    with open(path, "r", encoding="utf-8") as f:
-        lines = f.read().splitlines()
-    if not lines:
-        return []
-    header = lines[0].split(",")
-    rows = []
-    for line in lines[1:]:
-        parts = split_csv_line(line, len(header))
-        r = {}
-        for i, k in enumerate(header):
-            r[k] = parts[i] if i < len(parts) else ""
-        rows.append(r)
-    return rows
-
-
-def to_float(x):
-    if x is None:
-        return None
-    s = str(x).strip()
-    if s == "":
-        return None
-    try:
-        return float(s)
-    except Exception:
-        return None
-
-
 def mean_std(vals):
     xs = [x for x in vals if x is not None]
     if not xs:
@@ -70,56 +23,48 @@ def mean_std(vals):
     return m, v ** 0.5
 
 
-def quantile(vals, q):
-    xs = sorted([x for x in vals if x is not None])
-    if not xs:
-        return None
-    if q <= 0:
-        return xs[0]
-    if q >= 1:
-        return xs[-1]
-    pos = (len(xs) - 1) * q
-    left = int(pos)
-    right = left + 1
-    if right >= len(xs):
-        return xs[left]
-    frac = pos - left
-    return xs[left] * (1 - frac) + xs[right] * frac
-
-
-def pick_rows(rows, year=None, month=None, start=None, end=None):
+def quantiles(vals, qs):
+    # one sort for every requested q; same linear interpolation as before
+    xs = np.sort(np.array([x for x in vals if x is not None], dtype=float))
     out = []
-    for r in rows:
-        d = r.get("date", "")
-        if not d:
-            continue
-        if year is not None and d[:4] != str(year):
+    for q in qs:
+        if len(xs) == 0:
+            out.append(None)
             continue
-        if month is not None and d[5:7] != f"{month:02d}":
+        if q <= 0:
+            out.append(float(xs[0]))
             continue
-        if start is not None and d < start:
+        if q >= 1:
+            out.append(float(xs[-1]))
             continue
-        if end is not None and d > end:
+        pos = (len(xs) - 1) * q
+        left = int(pos)
+        right = left + 1
+        if right >= len(xs):
+            out.append(float(xs[left]))
             continue
-        out.append(r)
+        frac = pos - left
+        out.append(float(xs[left]) * (1 - frac) + float(xs[right]) * frac)
     return out
 
 
-def save_csv(path, rows, keys):
-    with open(path, "w", encoding="utf-8") as f:
-        f.write(",".join(keys) + "\n")
-        for r in rows:
-            parts = []
-            for k in keys:
-                v = r.get(k)
-                if v is None:
-                    parts.append("")
-                else:
-                    s = str(v).replace('"', '""')
-                    if "," in s or "\n" in s:
-                        s = f'"{s}"'
-                    parts.append(s)
-            f.write(",".join(parts) + "\n")
+def quantile(vals, q):
+    return quantiles(vals, [q])[0]
+
+
+def pick_rows(table, year=None, month=None, start=None, end=None):
+    # calendar picks go through the table's month offset index; single months and years stay views
+    if year is not None and month is not None:
+        out = table.month_rows(month, year, year)
+    elif year is not None:
+        out = table.year_rows(year)
+    elif month is not None:
+        out = table.month_rows(month)
+    else:
+        out = table
+    if start is not None or end is not None:
+        out = out.slice_dates(start, end)
+    return out
 
 
 def save_text(path, text):
@@ -127,95 +72,84 @@ def save_text(path, text):
         f.write(text)
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input", default="data/processed/la_daily_cdo.csv")
-    parser.add_argument("--out_folder", default="results")
-    parser.add_argument("--z_cut", type=float, default=2.0)
-    args = parser.parse_args()
-
-    make_folder(args.out_folder)
-
-    rows = read_csv(args.input)
-
-    for r in rows:
-        r["prcp_mm"] = to_float(r.get("prcp_mm"))
-        r["prcp_z_nov"] = to_float(r.get("prcp_z_nov"))
-        r["temp_avg_c"] = to_float(r.get("temp_avg_c"))
-
-    hist_nov = []
-    for r in rows:
-        d = r.get("date", "")
-        if not d:
-            continue
-        y = int(d[:4])
-        m = int(d[5:7])
-        if 2015 <= y <= 2024 and m == 11:
-            hist_nov.append(r)
-
-    hist_vals = [r["prcp_mm"] for r in hist_nov if r["prcp_mm"] is not None]
-    m, s = mean_std(hist_vals)
+def analyze(table, out_folder, z_cut=2.0, baseline=None):
+    hist = table.month_rows(11, 2015, 2024)
+    hist_vals = [x for x in hist["prcp_mm"].tolist() if x == x]
+    m, s = baseline if baseline is not None else mean_std(hist_vals)
 
     summary_lines = []
     summary_lines.append("Baseline (Nov 2015–2024) for LA daily precipitation (mm)")
     summary_lines.append(f"days_used: {len(hist_vals)}")
     summary_lines.append(f"mean_mm: {m}")
     summary_lines.append(f"std_mm: {s}")
-    summary_lines.append(f"p50_mm: {quantile(hist_vals, 0.50)}")
-    summary_lines.append(f"p75_mm: {quantile(hist_vals, 0.75)}")
-    summary_lines.append(f"p90_mm: {quantile(hist_vals, 0.90)}")
-    summary_lines.append(f"p95_mm: {quantile(hist_vals, 0.95)}")
+    for q, v in zip(SUMMARY_QS, quantiles(hist_vals, SUMMARY_QS)):
+        summary_lines.append(f"p{round(q * 100)}_mm: {v}")
     summary_lines.append("")
 
-    nov_2024 = pick_rows(rows, year=2024, month=11)
-    nov_2024_out = []
-    for r in nov_2024:
-        one = {}
-        one["date"] = r.get("date")
-        one["prcp_mm"] = r.get("prcp_mm")
-        one["prcp_z_nov"] = r.get("prcp_z_nov")
-        one["temp_avg_c"] = r.get("temp_avg_c")
-        nov_2024_out.append(one)
-
-    save_csv(
-        os.path.join(args.out_folder, "nov_2024_daily.csv"),
-        nov_2024_out,
-        ["date", "prcp_mm", "prcp_z_nov", "temp_avg_c"],
-    )
-
-    big_days = []
-    for r in nov_2024_out:
-        z = r.get("prcp_z_nov")
-        if z is not None and z >= args.z_cut:
-            big_days.append(r)
-
-    save_csv(
-        os.path.join(args.out_folder, "nov_2024_anomaly_days.csv"),
-        big_days,
-        ["date", "prcp_mm", "prcp_z_nov", "temp_avg_c"],
-    )
+    nov_2024 = pick_rows(table, year=2024, month=11)
+
+    save_table_csv(os.path.join(out_folder, "nov_2024_daily.csv"), nov_2024, OUT_KEYS)
+
+    big_days = nov_2024.take(nov_2024["prcp_z_nov"] >= z_cut)
+
+    save_table_csv(os.path.join(out_folder, "nov_2024_anomaly_days.csv"), big_days, OUT_KEYS)
 
     summary_lines.append("Nov 2024 precipitation summary")
-    nov_vals = [r["prcp_mm"] for r in nov_2024_out if r["prcp_mm"] is not None]
+    nov_vals = [x for x in nov_2024.values("prcp_mm") if x is not None]
     summary_lines.append(f"days_used: {len(nov_vals)}")
     summary_lines.append(f"mean_mm: {mean_std(nov_vals)[0]}")
     summary_lines.append(f"total_mm: {sum(nov_vals) if nov_vals else None}")
     summary_lines.append(f"max_mm: {max(nov_vals) if nov_vals else None}")
     summary_lines.append("")
-    summary_lines.append(f"Anomaly cutoff: z >= {args.z_cut}")
+    summary_lines.append(f"Anomaly cutoff: z >= {z_cut}")
     summary_lines.append(f"anomaly_days_count: {len(big_days)}")
-    if big_days:
+    if len(big_days):
         summary_lines.append("anomaly_days:")
-        for r in big_days:
+        for r in big_days.to_rows():
             summary_lines.append(f"- {r['date']} (mm={r['prcp_mm']}, z={r['prcp_z_nov']})")
 
-    save_text(os.path.join(args.out_folder, "analysis_summary.txt"), "\n".join(summary_lines))
+    save_text(os.path.join(out_folder, "analysis_summary.txt"), "\n".join(summary_lines))
+
+    return {
+        "baseline_days": len(hist_vals),
+        "baseline_mean_mm": m,
+        "baseline_std_mm": s,
+        "nov_2024_days": len(nov_vals),
+        "nov_2024_total_mm": sum(nov_vals) if nov_vals else None,
+        "nov_2024_max_mm": max(nov_vals) if nov_vals else None,
+        "anomaly_days_count": len(big_days),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="data/processed/la_daily_cdo.csv")
+    parser.add_argument("--out_folder", default="results")
+    parser.add_argument("--z_cut", type=float, default=2.0)
+    parser.add_argument("--baseline_store", default=None)
+    parser.add_argument("--station", default="GHCND:USW00023174")
+    add_metrics_args(parser, "run_analysis")
+    args = parser.parse_args()
+
+    with instrumented(args):
+        make_folder(args.out_folder)
+
+        baseline = None
+        if args.baseline_store:
+            baseline = BaselineStore(args.baseline_store).baseline(args.station, "prcp_mm", "month", 11, 2015, 2024)
+            if baseline[0] is None:
+                baseline = None
+
+        with stage("read_table"):
+            table = read_table(args.input, columns=OUT_KEYS, start="2015-11-01", end="2024-11-30")
+        with stage("analyze"):
+            analyze(table, args.out_folder, args.z_cut, baseline)
 
-    print("saved:")
-    print(os.path.join(args.out_folder, "analysis_summary.txt"))
-    print(os.path.join(args.out_folder, "nov_2024_daily.csv"))
-    print(os.path.join(args.out_folder, "nov_2024_anomaly_days.csv"))
+        print("saved:")
+        print(os.path.join(args.out_folder, "analysis_summary.txt"))
+        print(os.path.join(args.out_folder, "nov_2024_daily.csv"))
+        print(os.path.join(args.out_folder, "nov_2024_anomaly_days.csv"))
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
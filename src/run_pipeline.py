@@ -0,0 +1,150 @@
+import os
+import argparse
+import matplotlib
+import get_cdo_daily
+import visualize_results
+from clean_data import build_daily, save_daily, daily_paths
+from run_analysis import OUT_KEYS, analyze
+from daily_table import read_table
+from response_cache import use_cache
+from http_client import shared_client
+from stage_cache import StageCache, code_version, digest_columns, digest_path, stage_key
+from metrics import add_metrics_args, count, instrumented, stage
+
+CLEAN_CODE = ["clean_data", "daily_table", "csv_reader", "climatology", "baseline_store"]
+ANALYZE_CODE = ["run_analysis", "daily_table", "csv_reader"]
+FIGURE_CODE = ["visualize_results", "daily_table"]
+RESULT_FILES = ["analysis_summary.txt", "nov_2024_daily.csv", "nov_2024_anomaly_days.csv"]
+
+
+def make_folder(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+
+def raw_paths(raw_folder, extra_daily):
+    return [
+        os.path.join(raw_folder, "cdo_hist_nov_2015_2024_daily.csv"),
+        os.path.join(raw_folder, "cdo_nov_dec_2024_daily.csv"),
+    ] + list(extra_daily)
+
+
+def fetch_stage(args):
+    token = os.environ.get("NOAA_TOKEN", "")
+    if not token and not args.offline:
+        raise RuntimeError('Missing NOAA_TOKEN. Set it like: export NOAA_TOKEN="..."')
+    if args.cache_dir:
+        use_cache(args.cache_dir, offline=args.offline)
+    shared_client(timeout=(10, args.timeout))
+    limiter = get_cdo_daily.TokenBucket(rate=get_cdo_daily.SEQUENTIAL_PER_SEC)
+    # upstream data can change at any time, so fetching is never skipped; the cache decides what hits the network
+    get_cdo_daily.fetch_default_ranges(token, args.station, args.raw_folder, 1, limiter)
+
+
+def clean_stage(cache, args):
+    # returns the cleaned table itself; later stages never re-read the processed file
+    inputs = raw_paths(args.raw_folder, args.extra_daily)
+    if args.no_processed:
+        cache.ran.append("clean")
+        return build_daily(inputs, windows=args.windows)
+
+    outputs = daily_paths(args.processed_folder, args.format)
+    key = stage_key(
+        inputs={p: digest_path(p) for p in inputs},
+        params={"windows": args.windows, "format": args.format},
+        code=code_version(CLEAN_CODE),
+    )
+    built = {}
+
+    def run():
+        built["daily"] = build_daily(inputs, windows=args.windows)
+        save_daily(built["daily"], args.processed_folder, args.format)
+
+    cache.run("clean", key, outputs, run)
+    if "daily" in built:
+        return built["daily"]
+    # still valid on disk: one read here replaces the two the separate scripts would do
+    return read_table(outputs[0])
+
+
+def analyze_stage(cache, args, daily):
+    # keyed on the columns analyze reads, so new feature columns upstream do not invalidate it
+    outputs = [os.path.join(args.results, name) for name in RESULT_FILES]
+    table = daily.slice_dates("2015-11-01", "2024-11-30").select(OUT_KEYS)
+    key = stage_key(
+        inputs={"columns": digest_columns(table, OUT_KEYS)},
+        params={"z_cut": args.z_cut},
+        code=code_version(ANALYZE_CODE),
+    )
+    cache.run("analyze", key, outputs, lambda: analyze(table, args.results, args.z_cut))
+
+
+def figure_key(data, name):
+    # a figure depends only on the columns it plots, the drawing and table code, and matplotlib
+    cols = visualize_results.FIGURES[name][1]
+    code = {"modules": code_version(FIGURE_CODE), "matplotlib": matplotlib.__version__}
+    return stage_key(inputs={"columns": digest_columns(data, cols)}, code=code)
+
+
+def figures_stage(cache, args, daily):
+    make_folder(args.figures)
+    data = daily.select(visualize_results.INPUT_COLS)
+    keys = {name: figure_key(data, name) for name in visualize_results.FIGURES}
+    outputs = {name: os.path.join(args.figures, name) for name in keys}
+
+    stale = [name for name in keys if not cache.fresh("figure:" + name, keys[name], [outputs[name]])]
+    cache.skipped.extend("figure:" + name for name in keys if name not in stale)
+    visualize_results.render_all(data, args.figures, args.jobs, names=stale)
+    for name in stale:
+        cache.record("figure:" + name, keys[name], [outputs[name]])
+        cache.ran.append("figure:" + name)
+    cache.save()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--raw_folder", default="data/raw")
+    parser.add_argument("--processed_folder", default="data/processed")
+    parser.add_argument("--results", default="results")
+    parser.add_argument("--figures", default="results/figures")
+    parser.add_argument("--extra_daily", nargs="*", default=[])
+    parser.add_argument("--format", choices=["csv", "cols", "both"], default="csv")
+    parser.add_argument("--windows", type=int, nargs="+", default=[7, 14])
+    parser.add_argument("--z_cut", type=float, default=2.0)
+    parser.add_argument("--jobs", type=int, default=1)
+    parser.add_argument("--fetch", action="store_true")
+    parser.add_argument("--station", default="GHCND:USW00023174")
+    parser.add_argument("--cache_dir", default="data/cache")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--timeout", type=float, default=120)
+    parser.add_argument("--no_processed", action="store_true")
+    parser.add_argument("--state", default="data/pipeline_state.json")
+    parser.add_argument("--force", action="store_true")
+    add_metrics_args(parser, "run_pipeline")
+    args = parser.parse_args()
+    # the figures always plot the 7-day rolling columns
+    args.windows = sorted(set(args.windows) | {7})
+
+    with instrumented(args):
+        for p in [args.raw_folder, args.processed_folder, args.results]:
+            make_folder(p)
+        cache = StageCache(args.state, force=args.force)
+
+        if args.fetch:
+            with stage("fetch"):
+                fetch_stage(args)
+        with stage("clean"):
+            daily = clean_stage(cache, args)
+        with stage("analyze"):
+            analyze_stage(cache, args, daily)
+        with stage("figures"):
+            figures_stage(cache, args, daily)
+        count("pipeline.stages_ran", len(cache.ran))
+        count("pipeline.stages_skipped", len(cache.skipped))
+
+        print("ran:", ", ".join(cache.ran) or "-")
+        print("skipped:", ", ".join(cache.skipped) or "-")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,182 @@
+import os
+import time
+import argparse
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import get_cdo_daily
+from clean_data import build_daily, save_daily
+from run_analysis import SUMMARY_QS, analyze
+from quantile_sketch import sketch_of, sketch_from_dict, merge_sketches
+from response_cache import use_cache
+from http_client import shared_client
+
+SUMMARY_KEYS = [
+    "station",
+    "status",
+    "days",
+    "baseline_days",
+    "baseline_mean_mm",
+    "baseline_std_mm",
+    "nov_2024_days",
+    "nov_2024_total_mm",
+    "nov_2024_max_mm",
+    "anomaly_days_count",
+    "seconds",
+    "error",
+]
+
+
+_limiter = None
+
+
+def init_worker(opts):
+    # one bucket per worker process for the whole batch, so its slice of the daily quota
+    # keeps counting across stations instead of starting over for each one; the response
+    # cache is opened here too since opening it walks the whole cache folder
+    global _limiter
+    _limiter = get_cdo_daily.TokenBucket(rate=opts["rate"], per_day=opts["per_day"])
+    if opts["cache_dir"] and not opts["skip_fetch"]:
+        use_cache(opts["cache_dir"], offline=opts["offline"])
+
+
+def make_folder(path):
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+
+def read_station_list(path_or_ids):
+    if os.path.exists(path_or_ids):
+        with open(path_or_ids, "r", encoding="utf-8") as f:
+            lines = f.read().splitlines()
+    else:
+        lines = path_or_ids.split(",")
+    out = []
+    for line in lines:
+        s = line.split("#")[0].strip()
+        if not s:
+            continue
+        s = s.split(",")[0].strip()
+        if not s.startswith("GHCND:"):
+            s = "GHCND:" + s
+        if s not in out:
+            out.append(s)
+    return out
+
+
+def station_folders(out_root, station_id):
+    base = os.path.join(out_root, get_cdo_daily.station_slug(station_id))
+    return {k: os.path.join(base, k) for k in ["raw", "processed", "results"]}
+
+
+def run_station(station_id, out_root, opts):
+    t0 = time.perf_counter()
+    row = {"station": station_id, "status": "ok"}
+    folders = station_folders(out_root, station_id)
+    for p in folders.values():
+        make_folder(p)
+
+    try:
+        if not opts["skip_fetch"]:
+            if _limiter is None:
+                init_worker(opts)
+            shared_client(timeout=(10, opts["timeout"]))
+            get_cdo_daily.fetch_default_ranges(opts["token"], station_id, folders["raw"], 1, _limiter)
+
+        raw_paths = [
+            os.path.join(folders["raw"], "cdo_hist_nov_2015_2024_daily.csv"),
+            os.path.join(folders["raw"], "cdo_nov_dec_2024_daily.csv"),
+        ]
+        daily = build_daily(raw_paths)
+        save_daily(daily, folders["processed"], opts["format"])
+        row["days"] = len(daily)
+        row.update(analyze(daily, folders["results"], opts["z_cut"]))
+        # a small sketch travels back instead of the values, so pooling stays bounded
+        row["sketch"] = sketch_of(daily.month_rows(11, 2015, 2024)["prcp_mm"]).to_dict()
+    except Exception as e:
+        row["status"] = "failed"
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    row["seconds"] = round(time.perf_counter() - t0, 3)
+    return row
+
+
+def save_summary(path, rows):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(",".join(SUMMARY_KEYS) + "\n")
+        for r in rows:
+            parts = []
+            for k in SUMMARY_KEYS:
+                v = r.get(k)
+                s = "" if v is None else str(v).replace('"', '""')
+                if "," in s or "\n" in s:
+                    s = f'"{s}"'
+                parts.append(s)
+            f.write(",".join(parts) + "\n")
+
+
+def save_pooled_quantiles(path, rows):
+    sketches = [sketch_from_dict(r["sketch"]) for r in rows if r.get("sketch")]
+    pooled = merge_sketches(sketches)
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("quantile,prcp_mm\n")
+        for q, v in zip(SUMMARY_QS, pooled.quantiles(SUMMARY_QS)):
+            f.write(f"{q},{'' if v is None else v}\n")
+    return pooled.n
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--stations", default="data/stations_socal.txt")
+    parser.add_argument("--out", default="results/stations")
+    parser.add_argument("--jobs", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--z_cut", type=float, default=2.0)
+    parser.add_argument("--format", choices=["csv", "cols", "both"], default="csv")
+    parser.add_argument("--skip_fetch", action="store_true")
+    parser.add_argument("--cache_dir", default="data/cache")
+    parser.add_argument("--offline", action="store_true")
+    parser.add_argument("--timeout", type=float, default=120)
+    args = parser.parse_args()
+
+    stations = read_station_list(args.stations)
+    token = os.environ.get("NOAA_TOKEN", "")
+    if not token and not (args.skip_fetch or args.offline):
+        raise RuntimeError('Missing NOAA_TOKEN. Set it like: export NOAA_TOKEN="..."')
+
+    make_folder(args.out)
+    jobs = max(1, min(args.jobs, len(stations)))
+    opts = {
+        "token": token,
+        "skip_fetch": args.skip_fetch,
+        "cache_dir": args.cache_dir,
+        "offline": args.offline,
+        "timeout": args.timeout,
+        "rate": get_cdo_daily.CDO_PER_SEC / jobs,
+        "per_day": get_cdo_daily.CDO_PER_DAY // jobs,
+        "format": args.format,
+        "z_cut": args.z_cut,
+    }
+
+    t0 = time.perf_counter()
+    rows = []
+    # every process gets an equal slice of the one CDO quota
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(opts,)) as pool:
+        futs = [pool.submit(run_station, s, args.out, opts) for s in stations]
+        for fut in as_completed(futs):
+            r = fut.result()
+            rows.append(r)
+            print(f"{r['station']}: {r['status']} days={r.get('days')} anomalies={r.get('anomaly_days_count')} ({r['seconds']}s)")
+
+    rows.sort(key=lambda r: stations.index(r["station"]))
+    summary_path = os.path.join(args.out, "stations_summary.csv")
+    save_summary(summary_path, rows)
+
+    pooled_path = os.path.join(args.out, "stations_nov_prcp_quantiles.csv")
+    n_pooled = save_pooled_quantiles(pooled_path, rows)
+
+    n_ok = sum(1 for r in rows if r["status"] == "ok")
+    print(f"stations: {len(rows)} ok: {n_ok} jobs: {jobs} wall: {time.perf_counter() - t0:.1f}s")
+    print(summary_path)
+    print(f"{pooled_path} (pooled {n_pooled} station-days)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,125 @@
 
 import os
+import re
 import time
 import argparse
-from datetime import datetime
-import requests
+import threading
+import numpy as np
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from http_client import shared_client, format_report, retry_after_seconds
+from ndjson_io import open_text
+from metrics import add_metrics_args, count, instrumented, stage
 from bs4 import BeautifulSoup
 
+try:
+    import lxml.html as lxml_html
+    from lxml import etree
+except ImportError:
+    lxml_html = None
+
 
 def make_folder(path):
     if not os.path.exists(path):
         os.makedirs(path)
 
 
-def grab_html(url, headers):
-    r = requests.get(url, headers=headers, timeout=30)
+class HostBudget:
+    # politeness for one host: at most max_in_flight requests, starts spaced by min_interval,
+    # and a shared pause that grows on 429/503 and shrinks again on success
+    def __init__(self, max_in_flight=2, min_interval=0.6, max_backoff=120.0):
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        self.lock = threading.Lock()
+        self.min_interval = min_interval
+        self.max_backoff = max_backoff
+        self.next_at = 0.0
+        self.backoff = 0.0
+
+    def __enter__(self):
+        self.slots.acquire()
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_at)
+            self.next_at = start + self.min_interval
+        time.sleep(start - now)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.slots.release()
+
+    def penalize(self, retry_after=None):
+        with self.lock:
+            self.backoff = min(self.max_backoff, max(2 * self.backoff, 2 * self.min_interval, 1.0))
+            delay = retry_after if retry_after is not None else self.backoff
+            self.next_at = max(self.next_at, time.monotonic() + delay)
+            return delay
+
+    def succeeded(self):
+        with self.lock:
+            self.backoff /= 2
+
+
+def grab_html(url, headers, client=None, budget=None, tries=5):
+    client = client or shared_client()
+    if budget is None:
+        tries = 1
+    for attempt in range(tries):
+        if budget is None:
+            r = client.get(url, headers=headers)
+        else:
+            with budget:
+                r = client.get(url, headers=headers)
+        if r.status_code in (429, 503) and attempt + 1 < tries:
+            delay = budget.penalize(retry_after_seconds(r.headers.get("Retry-After")))
+            print(f"timeanddate returned {r.status_code}, backing off {delay:.1f}s: {url}")
+            count("http.retries")
+            continue
+        break
     if r.status_code != 200:
         raise RuntimeError(f"timeanddate returned {r.status_code}: {r.text[:200]}")
+    if budget is not None:
+        budget.succeeded()
     return r.text
 
 
-def save_text(path, text):
-    with open(path, "w", encoding="utf-8") as f:
+def archive_path(archive_root, city_slug, year, month):
+    return os.path.join(archive_root, city_slug, str(year), f"{month:02d}.html.gz")
+
+
+def save_archived(path, text):
+    make_folder(os.path.dirname(path))
+    tmp = path + ".part"
+    with open_text(tmp, "w", gz=True) as f:
         f.write(text)
+    os.replace(tmp, path)
+
+
+def load_archived(path):
+    with open_text(path, "r") as f:
+        return f.read()
+
+
+def archived_months(archive_root, city_slug):
+    out = []
+    city_root = os.path.join(archive_root, city_slug)
+    if not os.path.isdir(city_root):
+        return out
+    for y in sorted(os.listdir(city_root)):
+        if not y.isdigit():
+            continue
+        for name in sorted(os.listdir(os.path.join(city_root, y))):
+            if name.endswith(".html.gz") and name[:2].isdigit():
+                out.append((int(y), int(name[:2])))
+    return out
+
+
+def archive_complete(path, year, month):
+    # only a copy downloaded after the month was over holds all of it; a day of slack covers the
+    # gap between this machine's clock and the city's time zone
+    if not os.path.exists(path):
+        return False
+    month_end = datetime(year + month // 12, month % 12 + 1, 1)
+    return datetime.fromtimestamp(os.path.getmtime(path)) >= month_end + timedelta(days=1)
 
 
 def clean_text(s):
@@ -45,28 +143,15 @@ def pick_first_table(soup):
     return best
 
 
-def parse_hourly_rows(html_text, year, month):
-    soup = BeautifulSoup(html_text, "html.parser")
-
-    table = soup.find("table", id="wt-his")
-    if table is None:
-        table = soup.find("table", class_="zebra tb-wt fw va-m")
-    if table is None:
-        table = pick_first_table(soup)
-    if table is None:
-        return []
-
-    rows = table.find_all("tr")
-
+def rows_from_cells(row_cells, year, month):
     data = []
     current_day = None
 
-    for tr in rows:
-        cells = tr.find_all("td")
+    for cells in row_cells:
         if not cells:
             continue
 
-        first = clean_text(cells[0].get_text(" ", strip=True))
+        first = clean_text(cells[0])
         if first.lower().startswith(("mon", "tue", "wed", "thu", "fri", "sat", "sun")):
             current_day = first
             continue
@@ -74,16 +159,12 @@ def parse_hourly_rows(html_text, year, month):
         if current_day is None:
             continue
 
-        time_str = clean_text(cells[0].get_text(" ", strip=True))
+        time_str = first
         if ":" not in time_str:
             continue
 
-        temp_str = clean_text(cells[1].get_text(" ", strip=True))
-        weather_str = clean_text(cells[2].get_text(" ", strip=True)) if len(cells) > 2 else ""
-        wind_str = clean_text(cells[3].get_text(" ", strip=True)) if len(cells) > 3 else ""
-        humidity_str = clean_text(cells[4].get_text(" ", strip=True)) if len(cells) > 4 else ""
-        pressure_str = clean_text(cells[5].get_text(" ", strip=True)) if len(cells) > 5 else ""
-        vis_str = clean_text(cells[6].get_text(" ", strip=True)) if len(cells) > 6 else ""
+        texts = [clean_text(c) for c in cells[1:7]]
+        texts += [""] * (6 - len(texts))
 
         data.append(
             {
@@ -91,31 +172,84 @@ def parse_hourly_rows(html_text, year, month):
                 "month": month,
                 "day_label": current_day,
                 "time_label": time_str,
-                "temp_text": temp_str,
-                "weather_text": weather_str,
-                "wind_text": wind_str,
-                "humidity_text": humidity_str,
-                "pressure_text": pressure_str,
-                "visibility_text": vis_str,
+                "temp_text": texts[0],
+                "weather_text": texts[1],
+                "wind_text": texts[2],
+                "humidity_text": texts[3],
+                "pressure_text": texts[4],
+                "visibility_text": texts[5],
             }
         )
 
     return data
 
 
-def grab_number(s):
-    if s is None:
+def parse_hourly_rows_soup(html_text, year, month):
+    soup = BeautifulSoup(html_text, "html.parser")
+
+    table = soup.find("table", id="wt-his")
+    if table is None:
+        table = soup.find("table", class_="zebra tb-wt fw va-m")
+    if table is None:
+        table = pick_first_table(soup)
+    if table is None:
+        return []
+
+    row_cells = ([td.get_text(" ", strip=True) for td in tr.find_all("td")] for tr in table.find_all("tr"))
+    return rows_from_cells(row_cells, year, month)
+
+
+WT_HIS_RE = re.compile(r"""<table\b[^>]*\bid=["']?wt-his\b""", re.I)
+TABLE_END_RE = re.compile(r"</table\s*>", re.I)
+TABLE_PARTS = ("thead", "tbody", "tfoot", "tr", "td", "th")
+
+
+def wt_his_well_formed(html_text):
+    # lxml and html.parser repair unclosed table tags differently, so the fast path only takes a
+    # wt-his table where every row, cell and section tag is closed and no table is nested inside
+    start = WT_HIS_RE.search(html_text)
+    if start is None:
+        return False
+    end = TABLE_END_RE.search(html_text, start.end())
+    if end is None:
+        return False
+    markup = html_text[start.start():end.start()].lower()
+    if markup.count("<table") != 1:
+        return False
+    return all(markup.count(f"<{t}>") + markup.count(f"<{t} ") == markup.count(f"</{t}>") for t in TABLE_PARTS)
+
+
+def element_text(el):
+    # same as bs4 get_text(" ", strip=True): stripped pieces, empties dropped, joined by a space
+    return " ".join(t.strip() for t in el.itertext() if t.strip())
+
+
+def parse_hourly_rows_lxml(html_text, year, month):
+    # only looks at the wt-his table; None means "not found or not well-formed, use the full soup path"
+    if "<![CDATA[" in html_text:
+        # bs4 keeps CDATA text, libxml2's HTML parser drops it
+        return None
+    if not wt_his_well_formed(html_text):
         return None
-    keep = []
-    for ch in s:
-        if ch.isdigit() or ch in ".-":
-            keep.append(ch)
-        elif keep:
-            break
     try:
-        return float("".join(keep))
-    except Exception:
+        doc = lxml_html.document_fromstring(html_text)
+    except (ValueError, etree.ParserError):
         return None
+    tables = doc.xpath('//table[@id="wt-his"]')
+    if not tables:
+        return None
+    # bs4's get_text leaves out script/style/template contents
+    etree.strip_elements(tables[0], "script", "style", "template", with_tail=False)
+    row_cells = ([element_text(td) for td in tr.iter("td")] for tr in tables[0].iter("tr"))
+    return rows_from_cells(row_cells, year, month)
+
+
+def parse_hourly_rows(html_text, year, month):
+    if lxml_html is not None:
+        rows = parse_hourly_rows_lxml(html_text, year, month)
+        if rows is not None:
+            return rows
+    return parse_hourly_rows_soup(html_text, year, month)
 
 
 def day_num_from_label(day_label):
@@ -137,59 +271,119 @@ def to_date_text(year, month, day_num):
         return None
 
 
-def summarize_daily(hourly_rows):
-    bucket = {}
-
-    for r in hourly_rows:
-        d = day_num_from_label(r.get("day_label", ""))
-        if d is None:
-            continue
-
-        key = (r["year"], r["month"], d)
-        if key not in bucket:
-            bucket[key] = {
-                "temps": [],
-                "humidities": [],
-                "pressures": [],
-                "vis": [],
-            }
+HOUR_RE = re.compile(r"(\d{1,2}):\d{2}\s*([ap]m)?", re.I)
+# a number is the first run of isdigit() or ".-" characters. isdigit() also accepts superscripts,
+# circled digits and the like, which \d does not, so those are added to the class. They all sit in
+# the first two planes; the rest of the code space is ideographs, tags and private use
+EXTRA_DIGITS = "".join(chr(c) for c in range(0x20000) if chr(c).isdigit() and not chr(c).isdecimal())
+NUMBER_RE = re.compile("[\\d" + re.escape(EXTRA_DIGITS) + ".\\-]+")
+DAILY_FIELDS = [
+    ("temp_text", "temps"),
+    ("humidity_text", "humidities"),
+    ("pressure_text", "pressures"),
+    ("visibility_text", "vis"),
+]
 
-        t = grab_number(r.get("temp_text", ""))
-        if t is not None:
-            bucket[key]["temps"].append(t)
 
-        h = grab_number(r.get("humidity_text", ""))
-        if h is not None:
-            bucket[key]["humidities"].append(h)
+def map_unique(texts, fn):
+    # timeanddate cells repeat a lot ("0%", "10 mi", "12:00 am"), so each distinct string is handled once
+    codes = {}
+    idx = [codes.setdefault(t, len(codes)) for t in texts]
+    values = np.array([fn(t) for t in codes], dtype=float)
+    return values[np.array(idx, dtype=np.int64)] if idx else np.zeros(0)
 
-        p = grab_number(r.get("pressure_text", ""))
-        if p is not None:
-            bucket[key]["pressures"].append(p)
 
-        v = grab_number(r.get("visibility_text", ""))
-        if v is not None:
-            bucket[key]["vis"].append(v)
+def number_or_nan(text):
+    m = NUMBER_RE.search(text) if text else None
+    try:
+        return float(m.group()) if m else np.nan
+    except ValueError:
+        return np.nan
+
+
+def numbers_from_text(texts):
+    # NaN where a cell has no number
+    return map_unique(texts, number_or_nan)
+
+
+def hour_of(time_label):
+    m = HOUR_RE.search(time_label or "")
+    if not m:
+        return -1
+    h = int(m.group(1))
+    ampm = (m.group(2) or "").lower()
+    if ampm:
+        h = h % 12 + (12 if ampm == "pm" else 0)
+    return h if 0 <= h < 24 else -1
+
+
+def summarize_daily(hourly_rows, extra=False):
+    labels = [r.get("day_label", "") for r in hourly_rows]
+    day_of = {t: day_num_from_label(t) for t in set(labels)}
+    # sort on the rank of each day number so any label digits stay exact
+    day_values = sorted({d for d in day_of.values() if d is not None})
+    rank = {d: i for i, d in enumerate(day_values)}
+    day = map_unique(labels, lambda t: -1 if day_of[t] is None else rank[day_of[t]])
+    year = np.array([r["year"] for r in hourly_rows], dtype=np.int64)
+    month = np.array([r["month"] for r in hourly_rows], dtype=np.int64)
+
+    # one stable sort by (year, month, day): groups come out in date order and rows keep
+    # their original order inside a day, so the per-day sums below add up exactly as before
+    keep = day >= 0
+    order = np.flatnonzero(keep)[np.lexsort((day[keep], month[keep], year[keep]))]
+    ys, ms, ds = year[order], month[order], day[order]
+    new_group = np.r_[True, (ys[1:] != ys[:-1]) | (ms[1:] != ms[:-1]) | (ds[1:] != ds[:-1])] if len(order) else np.zeros(0, dtype=bool)
+    group = np.cumsum(new_group) - 1
+    firsts = np.flatnonzero(new_group)
+    n_groups = len(firsts)
+
+    cols = {}
+    for field, name in DAILY_FIELDS:
+        x = numbers_from_text([r.get(field, "") for r in hourly_rows])[order]
+        ok = ~np.isnan(x)
+        g, v = group[ok], x[ok]
+        count = np.bincount(g, minlength=n_groups)
+        starts = np.r_[0, np.cumsum(count)[:-1]] if n_groups else np.zeros(0, dtype=np.int64)
+        has = count > 0
+        hi = np.full(n_groups, np.nan)
+        lo = np.full(n_groups, np.nan)
+        if len(v):
+            hi[has] = np.maximum.reduceat(v, starts[has])
+            lo[has] = np.minimum.reduceat(v, starts[has])
+        cols[name] = (count.tolist(), hi.tolist(), lo.tolist(), np.split(v, starts[1:]) if n_groups else [])
+
+    if extra:
+        hours = map_unique([r.get("time_label", "") for r in hourly_rows], hour_of).astype(np.int64)[order]
+        seen = np.unique(group[hours >= 0] * 24 + hours[hours >= 0])
+        covered = np.bincount(seen // 24, minlength=n_groups).tolist()
+        obs = np.bincount(group, minlength=n_groups).tolist()
 
     out = []
-    for (y, m, d), stuff in sorted(bucket.items()):
-        temps = stuff["temps"]
-        hum = stuff["humidities"]
-        pres = stuff["pressures"]
-        vis = stuff["vis"]
-
+    for i, (y, m, d_rank) in enumerate(zip(ys[firsts].tolist(), ms[firsts].tolist(), ds[firsts].tolist())):
+        d = day_values[int(d_rank)]
         row = {}
         row["date"] = to_date_text(y, m, d)
         row["year"] = y
         row["month"] = m
         row["day"] = d
 
-        row["temp_high_f"] = max(temps) if temps else None
-        row["temp_low_f"] = min(temps) if temps else None
-        row["temp_avg_f"] = (sum(temps) / len(temps)) if temps else None
+        count, hi, lo, chunks = cols["temps"]
+        n = count[i]
+        row["temp_high_f"] = hi[i] if n else None
+        row["temp_low_f"] = lo[i] if n else None
+        row["temp_avg_f"] = (sum(chunks[i].tolist()) / n) if n else None
 
-        row["humidity_avg_pct"] = (sum(hum) / len(hum)) if hum else None
-        row["pressure_avg"] = (sum(pres) / len(pres)) if pres else None
-        row["visibility_avg"] = (sum(vis) / len(vis)) if vis else None
+        for name, key in [("humidities", "humidity_avg_pct"), ("pressures", "pressure_avg"), ("vis", "visibility_avg")]:
+            count, _, _, chunks = cols[name]
+            row[key] = (sum(chunks[i].tolist()) / count[i]) if count[i] else None
+
+        if extra:
+            n = cols["temps"][0][i]
+            row["temp_median_f"] = float(np.median(cols["temps"][3][i])) if n else None
+            row["temp_count"] = n
+            row["obs_count"] = obs[i]
+            row["hours_covered"] = covered[i]
+            row["hourly_coverage"] = round(covered[i] / 24, 4)
 
         out.append(row)
 
@@ -219,25 +413,41 @@ def save_csv(path, rows):
             f.write(",".join(parts) + "\n")
 
 
-def run_one_month(city_slug, year, month, out_folder, headers, sleep_sec=0.6):
-    url = f"https://www.timeanddate.com/weather/usa/{city_slug}/historic?month={month}&year={year}"
-    html_text = grab_html(url, headers)
-
-    raw_html_name = f"timeanddate_{city_slug}_{year}_{month:02d}.html"
-    raw_html_path = os.path.join(out_folder, raw_html_name)
-    save_text(raw_html_path, html_text)
-
-    hourly = parse_hourly_rows(html_text, year, month)
+def run_one_month(
+    city_slug, year, month, out_folder, headers, sleep_sec=0.6, budget=None, archive_root=None, reparse=False, extra_stats=False
+):
+    archive_root = archive_root or os.path.join(out_folder, "timeanddate_html")
+    raw_html_path = archive_path(archive_root, city_slug, year, month)
+    fetched = False
+
+    # a closed month never changes upstream, so a copy fetched after it ended is as good as a download
+    if reparse or archive_complete(raw_html_path, year, month):
+        html_text = load_archived(raw_html_path)
+    else:
+        url = f"https://www.timeanddate.com/weather/usa/{city_slug}/historic?month={month}&year={year}"
+        with stage("grab_html"):
+            html_text = grab_html(url, headers, budget=budget)
+        save_archived(raw_html_path, html_text)
+        fetched = True
+    count("timeanddate.pages_fetched" if fetched else "timeanddate.pages_archived")
+
+    with stage("parse_hourly_rows"):
+        hourly = parse_hourly_rows(html_text, year, month)
     hourly_csv_name = f"timeanddate_{city_slug}_{year}_{month:02d}_hourly.csv"
     hourly_csv_path = os.path.join(out_folder, hourly_csv_name)
     save_csv(hourly_csv_path, hourly)
 
-    daily = summarize_daily(hourly)
+    with stage("summarize_daily"):
+        daily = summarize_daily(hourly, extra_stats)
     daily_csv_name = f"timeanddate_{city_slug}_{year}_{month:02d}_daily.csv"
     daily_csv_path = os.path.join(out_folder, daily_csv_name)
     save_csv(daily_csv_path, daily)
+    count("timeanddate.hourly_rows", len(hourly))
+    count("timeanddate.days", len(daily))
 
-    time.sleep(sleep_sec)
+    # with a budget the spacing is already enforced before each request
+    if fetched and budget is None:
+        time.sleep(sleep_sec)
 
     return raw_html_path, hourly_csv_path, daily_csv_path, len(hourly), len(daily)
 
@@ -252,26 +462,45 @@ def main():
     parser.add_argument("--extra_year", type=int, default=2024)
     parser.add_argument("--extra_month", type=int, default=12)
     parser.add_argument("--user_agent", default="DSCI510-FinalProject (xwang663@usc.edu)")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--max_in_flight", type=int, default=2)
+    parser.add_argument("--min_interval", type=float, default=0.6)
+    parser.add_argument("--archive", default=None)
+    parser.add_argument("--reparse", action="store_true")
+    parser.add_argument("--extra_stats", action="store_true")
+    add_metrics_args(parser, "scrape_timeanddate")
     args = parser.parse_args()
 
-    make_folder(args.out)
-
-    headers = {"User-Agent": args.user_agent}
-
-    for y in range(args.start_year, args.end_year + 1):
-        raw_path, hourly_path, daily_path, n_hourly, n_daily = run_one_month(
-            args.city, y, args.month, args.out, headers
-        )
-        print(raw_path)
-        print(hourly_path, n_hourly)
-        print(daily_path, n_daily)
-
-    raw_path, hourly_path, daily_path, n_hourly, n_daily = run_one_month(
-        args.city, args.extra_year, args.extra_month, args.out, headers
-    )
-    print(raw_path)
-    print(hourly_path, n_hourly)
-    print(daily_path, n_daily)
+    with instrumented(args):
+        make_folder(args.out)
+        archive_root = args.archive or os.path.join(args.out, "timeanddate_html")
+        client = shared_client(timeout=(10, args.timeout), per_host=max(args.max_in_flight, 1))
+
+        headers = {"User-Agent": args.user_agent}
+        if args.reparse:
+            # every archived month of the city, rebuilt without touching the network
+            months = archived_months(archive_root, args.city)
+            if not months:
+                raise RuntimeError(f"--reparse: no archived pages for {args.city} under {archive_root}")
+        else:
+            months = [(y, args.month) for y in range(args.start_year, args.end_year + 1)]
+            months.append((args.extra_year, args.extra_month))
+
+        # parsing and writing happen in the worker after its request slot is released,
+        # so they overlap with the next downloads instead of adding to the wall time
+        budget = HostBudget(args.max_in_flight, args.min_interval)
+        with ThreadPoolExecutor(max_workers=max(args.workers, 1)) as pool:
+            futs = [
+                pool.submit(run_one_month, args.city, y, m, args.out, headers, 0, budget, archive_root, args.reparse, args.extra_stats)
+                for y, m in months
+            ]
+            for fut in futs:
+                raw_path, hourly_path, daily_path, n_hourly, n_daily = fut.result()
+                print(raw_path)
+                print(hourly_path, n_hourly)
+                print(daily_path, n_daily)
+        print(format_report(client.report()))
 
 
 if __name__ == "__main__":
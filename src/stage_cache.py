@@ -0,0 +1,89 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def digest_text(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def digest_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def digest_path(path):
+    # a .cols folder is hashed file by file in a fixed order
+    if not os.path.exists(path):
+        return None
+    if not os.path.isdir(path):
+        return digest_file(path)
+    parts = [[name, digest_file(os.path.join(path, name))] for name in sorted(os.listdir(path))]
+    return digest_text(json.dumps(parts))
+
+
+def digest_columns(table, keys):
+    h = hashlib.sha256()
+    for k in ["date"] + [k for k in keys if k != "date"]:
+        arr = np.ascontiguousarray(table[k])
+        h.update(k.encode("utf-8"))
+        h.update(str(arr.dtype).encode("utf-8"))
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+
+def code_version(modules):
+    return {m: digest_file(os.path.join(SRC_DIR, m + ".py")) for m in modules}
+
+
+def stage_key(inputs=None, params=None, code=None):
+    return digest_text(json.dumps({"inputs": inputs or {}, "params": params or {}, "code": code or {}}, sort_keys=True))
+
+
+class StageCache:
+    def __init__(self, path, force=False):
+        self.path = path
+        self.force = force
+        self.ran = []
+        self.skipped = []
+        self.state = {}
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                self.state = json.load(f)
+
+    def fresh(self, name, key, outputs):
+        # valid only if the key matches and nobody touched or removed the outputs since
+        entry = self.state.get(name)
+        if self.force or entry is None or entry["key"] != key:
+            return False
+        for p in outputs:
+            if digest_path(p) != entry["outputs"].get(p):
+                return False
+        return True
+
+    def record(self, name, key, outputs):
+        self.state[name] = {"key": key, "outputs": {p: digest_path(p) for p in outputs}}
+
+    def run(self, name, key, outputs, fn):
+        if self.fresh(name, key, outputs):
+            self.skipped.append(name)
+            return False
+        fn()
+        self.record(name, key, outputs)
+        self.ran.append(name)
+        self.save()
+        return True
+
+    def save(self):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
@@ -1,7 +1,26 @@
 import os
+import time
 import argparse
-from datetime import datetime
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import matplotlib
+
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
+import numpy as np
+from daily_table import read_table, save_table_cols
+from metrics import add_metrics_args, instrumented, stage
+
+INPUT_COLS = [
+    "temp_avg_c",
+    "tmax_c",
+    "tmin_c",
+    "prcp_mm",
+    "prcp_z_nov",
+    "awnd_ms",
+    "temp_avg_c_roll7",
+    "prcp_mm_roll7",
+]
 
 
 def make_folder(path):
@@ -9,145 +28,47 @@ def make_folder(path):
         os.makedirs(path)
 
 
-def split_csv_line(line, want_cols):
-    out = []
-    cur = ""
-    in_q = False
-    i = 0
-    while i < len(line):
-        ch = line[i]
-        if ch == '"':
-            if in_q and i + 1 < len(line) and line[i + 1] == '"':
-                cur += '"'
-                i += 1
-            else:
-                in_q = not in_q
-        elif ch == "," and not in_q:
-            out.append(cur)
-            cur = ""
-        else:
-            cur += ch
-        i += 1
-    out.append(cur)
-    while len(out) < want_cols:
-        out.append("")
-    return out
-
-
-def read_csv(path):
-    with open(path, "r", encoding="utf-8") as f:
-        lines = f.read().splitlines()
-    if not lines:
-        return []
-    header = lines[0].split(",")
-    rows = []
-    for line in lines[1:]:
-        parts = split_csv_line(line, len(header))
-        r = {}
-        for i, k in enumerate(header):
-            r[k] = parts[i] if i < len(parts) else ""
-        rows.append(r)
-    return rows
-
-
-def to_float(x):
-    s = str(x).strip()
-    if s == "":
-        return None
-    try:
-        return float(s)
-    except Exception:
-        return None
-
-
-def to_date_num(s):
-    try:
-        return datetime.strptime(s, "%Y-%m-%d")
-    except Exception:
-        return None
-
-
 def save_fig(path):
     plt.tight_layout()
     plt.savefig(path, dpi=200)
     plt.close()
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument("--input", default="data/processed/la_daily_cdo.csv")
-    parser.add_argument("--out_folder", default="results/figures")
-    args = parser.parse_args()
-
-    make_folder(args.out_folder)
-
-    rows = read_csv(args.input)
-
-    data = []
-    for r in rows:
-        d = r.get("date")
-        dt = to_date_num(d)
-        if not dt:
-            continue
-
-        one = {}
-        one["date"] = d
-        one["dt"] = dt
-        one["year"] = int(d[:4])
-        one["month"] = int(d[5:7])
-
-        one["temp_avg_c"] = to_float(r.get("temp_avg_c"))
-        one["tmax_c"] = to_float(r.get("tmax_c"))
-        one["tmin_c"] = to_float(r.get("tmin_c"))
-        one["prcp_mm"] = to_float(r.get("prcp_mm"))
-        one["prcp_z_nov"] = to_float(r.get("prcp_z_nov"))
-        one["awnd_ms"] = to_float(r.get("awnd_ms"))
-        one["temp_avg_c_roll7"] = to_float(r.get("temp_avg_c_roll7"))
-        one["prcp_mm_roll7"] = to_float(r.get("prcp_mm_roll7"))
-
-        data.append(one)
-
-    data = sorted(data, key=lambda x: x["dt"])
-
-    x_all = [r["dt"] for r in data]
-    tmax = [r["tmax_c"] for r in data]
-    tmin = [r["tmin_c"] for r in data]
-
+def plot_temp(data, path):
     plt.figure()
-    plt.plot(x_all, tmax, label="daily max (C)")
-    plt.plot(x_all, tmin, label="daily min (C)")
+    plt.plot(data.dates, data["tmax_c"], label="daily max (C)")
+    plt.plot(data.dates, data["tmin_c"], label="daily min (C)")
     plt.title("Daily Temperature (TMAX/TMIN) - LA (CDO)")
     plt.xlabel("date")
     plt.ylabel("C")
     plt.legend()
-    save_fig(os.path.join(args.out_folder, "temp_tmax_tmin.png"))
+    save_fig(path)
+
 
-    pr = [r["prcp_mm"] for r in data]
+def plot_precip(data, path):
     plt.figure()
-    plt.plot(x_all, pr)
+    plt.plot(data.dates, data["prcp_mm"])
     plt.title("Daily Precipitation (mm) - LA (CDO)")
     plt.xlabel("date")
     plt.ylabel("mm")
-    save_fig(os.path.join(args.out_folder, "precip_daily.png"))
+    save_fig(path)
 
-    pr7 = [r["prcp_mm_roll7"] for r in data]
+
+def plot_precip_roll7(data, path):
     plt.figure()
-    plt.plot(x_all, pr7)
+    plt.plot(data.dates, data["prcp_mm_roll7"])
     plt.title("7-day Rolling Avg Precipitation (mm) - LA (CDO)")
     plt.xlabel("date")
     plt.ylabel("mm")
-    save_fig(os.path.join(args.out_folder, "precip_roll7.png"))
+    save_fig(path)
 
-    nov_rows = [r for r in data if r["month"] == 11 and 2015 <= r["year"] <= 2024]
-    by_year = {}
-    for r in nov_rows:
-        y = r["year"]
-        if y not in by_year:
-            by_year[y] = []
-        by_year[y].append(r["temp_avg_c"])
 
-    years = sorted(by_year.keys())
-    box_data = [by_year[y] for y in years]
+def plot_nov_box(data, path):
+    idx = data.index()
+    temp = data["temp_avg_c"]
+    nov_slices = [(y, idx.month_slice(y, 11)) for y in range(2015, 2025)]
+    years = [y for y, sl in nov_slices if sl.stop > sl.start]
+    box_data = [temp[sl][~np.isnan(temp[sl])] for y, sl in nov_slices if sl.stop > sl.start]
 
     plt.figure()
     plt.boxplot(box_data, labels=[str(y) for y in years], showfliers=False)
@@ -155,32 +76,98 @@ def main():
     plt.xlabel("year")
     plt.ylabel("temp avg (C)")
     plt.xticks(rotation=45)
-    save_fig(os.path.join(args.out_folder, "box_nov_temp_by_year.png"))
+    save_fig(path)
+
 
-    nov24 = [r for r in data if r["year"] == 2024 and r["month"] == 11]
-    x_nov24 = [r["dt"] for r in nov24]
-    z_nov24 = [r["prcp_z_nov"] for r in nov24]
+def plot_nov24_z(data, path):
+    nov24 = data.month_rows(11, 2024, 2024)
 
     plt.figure()
-    plt.plot(x_nov24, z_nov24)
+    plt.plot(nov24.dates, nov24["prcp_z_nov"])
     plt.axhline(2.0, linestyle="--")
     plt.title("Nov 2024 Precip Z-score (baseline: Nov 2015–2024)")
     plt.xlabel("date")
     plt.ylabel("z-score")
-    save_fig(os.path.join(args.out_folder, "nov2024_precip_z.png"))
+    save_fig(path)
 
-    temp = [r["temp_avg_c"] for r in data if r["temp_avg_c"] is not None and r["awnd_ms"] is not None]
-    wind = [r["awnd_ms"] for r in data if r["temp_avg_c"] is not None and r["awnd_ms"] is not None]
+
+def plot_temp_wind(data, path):
+    both = ~np.isnan(data["temp_avg_c"]) & ~np.isnan(data["awnd_ms"])
 
     plt.figure()
-    plt.scatter(temp, wind)
+    plt.scatter(data["temp_avg_c"][both], data["awnd_ms"][both])
     plt.title("Temp Avg (C) vs Wind Speed (m/s) - LA (CDO)")
     plt.xlabel("temp avg (C)")
     plt.ylabel("wind (m/s)")
-    save_fig(os.path.join(args.out_folder, "scatter_temp_vs_wind.png"))
+    save_fig(path)
+
+
+# name -> (plot function, columns it reads); every entry is an independent job
+FIGURES = {
+    "temp_tmax_tmin.png": (plot_temp, ["tmax_c", "tmin_c"]),
+    "precip_daily.png": (plot_precip, ["prcp_mm"]),
+    "precip_roll7.png": (plot_precip_roll7, ["prcp_mm_roll7"]),
+    "box_nov_temp_by_year.png": (plot_nov_box, ["temp_avg_c"]),
+    "nov2024_precip_z.png": (plot_nov24_z, ["prcp_z_nov"]),
+    "scatter_temp_vs_wind.png": (plot_temp_wind, ["temp_avg_c", "awnd_ms"]),
+}
+
+
+def render_figure(name, data, out_folder):
+    t0 = time.perf_counter()
+    path = os.path.join(out_folder, name)
+    with stage("figure:" + name):
+        FIGURES[name][0](data, path)
+    return name, path, time.perf_counter() - t0
+
+
+def render_from_cols(name, cols_folder, out_folder):
+    # workers load only their own columns from the shared .npy files
+    data = read_table(cols_folder, columns=FIGURES[name][1])
+    return render_figure(name, data, out_folder)
+
+
+def render_all(data, out_folder, jobs=1, cols_folder=None, names=None):
+    names = list(FIGURES) if names is None else names
+    if not names:
+        return []
+    if jobs <= 1:
+        return [render_figure(name, data, out_folder) for name in names]
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if cols_folder is None:
+            cols_folder = os.path.join(tmp, "figure_data.cols")
+            save_table_cols(cols_folder, data)
+        with ProcessPoolExecutor(max_workers=min(jobs, len(names))) as pool:
+            futs = [pool.submit(render_from_cols, name, cols_folder, out_folder) for name in names]
+            done = [fut.result() for fut in as_completed(futs)]
+    order = list(FIGURES)
+    return sorted(done, key=lambda r: order.index(r[0]))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="data/processed/la_daily_cdo.csv")
+    parser.add_argument("--out_folder", default="results/figures")
+    parser.add_argument("--jobs", type=int, default=1)
+    add_metrics_args(parser, "visualize_results")
+    args = parser.parse_args()
+
+    with instrumented(args):
+        make_folder(args.out_folder)
+
+        t0 = time.perf_counter()
+        if args.jobs > 1 and os.path.isdir(args.input):
+            rendered = render_all(None, args.out_folder, args.jobs, cols_folder=args.input)
+        else:
+            data = read_table(args.input, columns=INPUT_COLS)
+            rendered = render_all(data, args.out_folder, args.jobs)
 
-    print("saved figures in:", args.out_folder)
+        for name, _, seconds in rendered:
+            print(f"{name}: {seconds:.2f}s")
+        print(f"figures: {len(rendered)} jobs: {args.jobs} wall: {time.perf_counter() - t0:.2f}s")
+        print("saved figures in:", args.out_folder)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()